@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""
+Benchmark of the pytest-doctest-custom plugin overhead per doctest example
+
+Generates synthetic modules with docstrings full of examples displaying
+several value shapes, then runs them with py.test in a subprocess for each
+formatter (plus the stock doctest display hook), reporting as JSON the time
+spent running the doctest items, the per-example overhead when compared to
+stock doctest, the throughput and the peak memory (resident set size).
+
+Syntax: python benchmark.py [--help] [options]
+
+This file is also the py.test plugin loaded in the subprocesses to collect
+the timings, which don't include the collection/import time.
+"""
+import sys, os, json, shutil, tempfile, subprocess, argparse
+
+PKG_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_ENV = "DOCTEST_CUSTOM_BENCHMARK_OUTPUT"
+
+FORMATTERS = ["repr", "pprint:pformat", "IPython.lib.pretty:pretty",
+              "pytest_doctest_custom:pretty"]
+
+SHAPES = {
+  "scalar": "{0} * 7",
+  "deep_dict": "deep_dict({0})",
+  "big_list": "list(range({0}, {0} + 500))",
+  "set": "set(range({0}, {0} + 100))",
+}
+
+HELPERS = '''
+def deep_dict(seed, depth=4):
+    if not depth:
+        return seed
+    return dict(("k%d" % idx, deep_dict(seed + idx, depth - 1))
+                for idx in range(3))
+'''
+
+
+def module_source(formatter, shapes, docstrings, examples, offset=0):
+    """
+    Source of a synthetic module with the given number of docstrings and
+    examples per docstring, cycling through the value shapes. The expected
+    outputs are rendered by the formatter itself, so the doctests pass.
+    """
+    namespace = {}
+    exec(HELPERS, namespace)
+    lines = [HELPERS]
+    for doc_idx in range(docstrings):
+        lines.append("def func{0}():".format(doc_idx))
+        lines.append('    r"""')
+        for ex_idx in range(examples):
+            idx = offset + doc_idx * examples + ex_idx
+            source = SHAPES[shapes[idx % len(shapes)]].format(idx)
+            want = formatter(eval(source, namespace))
+            lines.append("    >>> " + source)
+            lines.extend("    " + line for line in want.splitlines())
+        lines.append('    """')
+    return "\n".join(lines) + "\n"
+
+
+def run_pytest(path, address, extra_args=()):
+    """Runs py.test in a subprocess, returning the benchmark plugin data."""
+    fd, output_name = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    env = dict(os.environ)
+    env[OUTPUT_ENV] = output_name
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [PKG_DIR,
+                                                      env.get("PYTHONPATH")]))
+    args = [sys.executable, "-m", "pytest", path, "-q",
+            "-p", "no:cacheprovider", "-p", "no:doctest_custom",
+            "-p", "pytest_doctest_custom", "-p", "benchmark",
+            "--doctest-modules"]
+    if address is not None:
+        args.extend(["--doctest-repr", address])
+    args.extend(extra_args)
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.call(args, env=env, stdout=devnull, cwd=path)
+        with open(output_name) as f:
+            return json.load(f)
+    finally:
+        os.remove(output_name)
+
+
+def benchmark(address, args):
+    """Best (minimum time) run data for a formatter address (None: stock)."""
+    from pytest_doctest_custom import parse_address
+    formatter = repr if address is None else parse_address(address)
+    path = tempfile.mkdtemp(prefix="doctest_custom_benchmark_")
+    try:
+        for mod_idx in range(args.modules):
+            offset = mod_idx * args.docstrings * args.examples
+            source = module_source(formatter, args.shapes, args.docstrings,
+                                   args.examples, offset)
+            mod_name = "synthetic{0}.py".format(mod_idx)
+            with open(os.path.join(path, mod_name), "w") as f:
+                f.write(source)
+        runs = [run_pytest(path, address, args.pytest_args)
+                for unused in range(args.repeat)]
+    finally:
+        shutil.rmtree(path)
+    return min(runs, key=lambda run: run["time"])
+
+
+def runner_benchmark(docstrings, repeat):
+    """
+    Time to run many small docstrings with the plugin printer installed by
+    globally wrapping ``doctest.DocTestRunner.run`` (as done up to 1.0.0)
+    or by the per-item ``runner_class``, both in this process.
+    """
+    import doctest
+    from timeit import default_timer
+    from pytest_doctest_custom import printer, runner_class, temp_replace
+    printer.repr = repr
+    replace_displayhook = temp_replace(sys, "__displayhook__", printer)
+    classes = {
+      "global_patch": type("GlobalPatchRunner", (doctest.DocTestRunner,), {
+        "run": replace_displayhook(doctest.DocTestRunner.run),
+      }),
+      "runner_class": runner_class(doctest.DocTestRunner),
+    }
+    parser = doctest.DocTestParser()
+    result = {"docstrings": docstrings}
+    for name, cls in sorted(classes.items()):
+        timings = []
+        for unused in range(repeat):
+            tests = [parser.get_doctest(">>> {0}\n{0}\n".format(idx), {},
+                                        "t{0}".format(idx), None, 0)
+                     for idx in range(docstrings)]
+            runner = cls()
+            start = default_timer()
+            for test in tests:
+                runner.run(test)
+            timings.append(default_timer() - start)
+            assert runner.failures == 0
+        result[name] = min(timings)
+    return result
+
+
+class GetattrProxy(object):
+    """The StandardStreamProxy up to 1.0.0, for comparison."""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr_name):
+        return getattr(self.stream, attr_name)
+
+    @property
+    def stream(self):
+        obj = getattr(sys, self._name)
+        return obj if obj is not self else getattr(sys, "__stdout__")
+
+
+def proxy_benchmark(writes, repeat):
+    """Cost per write (in ns) of small chunks through the stdout proxies."""
+    from io import StringIO
+    from timeit import default_timer
+    from pytest_doctest_custom import BufferedStream, StandardStreamProxy
+    def write_direct(stream):
+        write = stream.write
+        for unused in range(writes):
+            write(u"x")
+    def write_getattr_proxy(stream):
+        proxy = GetattrProxy("stdout")
+        for unused in range(writes):
+            proxy.write(u"x")
+    def write_proxy(stream):
+        proxy = StandardStreamProxy("stdout")
+        for unused in range(writes):
+            proxy.write(u"x")
+    def write_buffered_proxy(stream):
+        proxy = StandardStreamProxy("stdout")
+        buffered = BufferedStream(stream)
+        token = proxy.bind(buffered)
+        for unused in range(writes):
+            proxy.write(u"x")
+        proxy.unbind(token)
+        buffered.flush_buffer()
+    result = {"writes": writes}
+    backup = sys.stdout
+    try:
+        for func in [write_direct, write_getattr_proxy, write_proxy,
+                     write_buffered_proxy]:
+            timings = []
+            for unused in range(repeat):
+                sys.stdout = stream = StringIO()
+                start = default_timer()
+                func(stream)
+                timings.append(default_timer() - start)
+                assert len(stream.getvalue()) == writes
+            result[func.__name__[6:] + "_ns"] = min(timings) * 1e9 / writes
+    finally:
+        sys.stdout = backup
+    return result
+
+
+def formatter_benchmark(addresses, calls, repeat):
+    """
+    Time per call (in microseconds) of each formatter for a value of each
+    shape, called directly in this process.
+    """
+    from timeit import default_timer
+    from pytest_doctest_custom import parse_address
+    namespace = {}
+    exec(HELPERS, namespace)
+    values = dict((shape, eval(source.format(1000), namespace))
+                  for shape, source in SHAPES.items())
+    result = {"calls": calls}
+    for address in addresses:
+        try:
+            formatter = parse_address(address)
+        except Exception as exc: # E.g. IPython isn't installed
+            result[address] = {"error": repr(exc)}
+            continue
+        timings = result[address] = {}
+        for shape, value in sorted(values.items()):
+            best = None
+            for unused in range(repeat):
+                start = default_timer()
+                for unused in range(calls):
+                    formatter(value)
+                elapsed = default_timer() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[shape + "_us"] = best * 1e6 / calls
+    return result
+
+
+def globals_benchmark(names, docstrings, repeat):
+    """
+    Memory held (traced with ``tracemalloc``) by the doctests found in a
+    module with many global names and single example docstrings, and the
+    time to find them, when each docstring gets a full copy of the module
+    namespace (stock) or ``LayeredGlobals`` (``--doctest-layered-globals``).
+    """
+    import doctest, tracemalloc, types
+    from timeit import default_timer
+    from pytest_doctest_custom import layered_find
+    module = types.ModuleType("synthetic_globals")
+    source = "".join(["name{0} = {0}\n".format(idx) for idx in range(names)] +
+                     ["def func{0}():\n    '>>> name{0}\\n{0}\\n'\n"
+                      .format(idx) for idx in range(docstrings)])
+    exec(compile(source, "<synthetic_globals>", "exec"), module.__dict__)
+    finds = {"stock": doctest.DocTestFinder.find,
+             "layered": layered_find(doctest.DocTestFinder.find)}
+    result = {"names": names, "docstrings": docstrings}
+    for name, find in sorted(finds.items()):
+        timings = []
+        for unused in range(repeat):
+            finder = doctest.DocTestFinder()
+            tracemalloc.start()
+            start = default_timer()
+            tests = find(finder, module)
+            timings.append(default_timer() - start)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert len(tests) == docstrings
+            del tests
+        result[name] = {"time": min(timings), "kib": current / 1024.,
+                        "peak_kib": peak / 1024.}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--modules", type=int, default=4)
+    parser.add_argument("--docstrings", type=int, default=25,
+                        help="number of docstrings per module")
+    parser.add_argument("--examples", type=int, default=8,
+                        help="number of examples per docstring")
+    parser.add_argument("--shapes", nargs="+", default=sorted(SHAPES),
+                        choices=sorted(SHAPES))
+    parser.add_argument("--formatter", dest="formatters", action="append",
+                        help="formatter address (can be used more than once)")
+    parser.add_argument("--small-docstrings", type=int, default=2000,
+                        help="number of single example docstrings for the "
+                             "doctest runner benchmark (0 to skip it)")
+    parser.add_argument("--proxy-writes", type=int, default=100000,
+                        help="number of writes for the stdout proxy "
+                             "benchmark (0 to skip it)")
+    parser.add_argument("--formatter-calls", type=int, default=200,
+                        help="number of calls per value shape for the "
+                             "in-process formatter benchmark (0 to skip it)")
+    parser.add_argument("--globals-names", type=int, default=1000,
+                        help="number of module global names for the layered "
+                             "globals benchmark (0 to skip it)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="JSON output file (default: stdout)")
+    parser.add_argument("pytest_args", nargs="*",
+                        help="extra py.test arguments (after a --)")
+    args = parser.parse_args(argv)
+    total = args.modules * args.docstrings * args.examples
+
+    results = []
+    stock = benchmark(None, args)
+    for address in [None] + (args.formatters or FORMATTERS):
+        try:
+            data = stock if address is None else benchmark(address, args)
+        except Exception as exc: # E.g. IPython isn't installed
+            results.append({"formatter": address, "error": repr(exc)})
+            continue
+        results.append({
+          "formatter": address or "stock",
+          "examples": total,
+          "passed": data["passed"],
+          "failed": data["failed"],
+          "time": data["time"],
+          "per_example": data["time"] / total,
+          "overhead_per_example": (data["time"] - stock["time"]) / total,
+          "throughput": total / data["time"] if data["time"] else None,
+          "peak_rss_kib": data["peak_rss_kib"],
+        })
+
+    import pytest, pytest_doctest_custom
+    report = {
+      "python": sys.version.split()[0],
+      "implementation": sys.subversion[0] if hasattr(sys, "subversion")
+                        else sys.implementation.name,
+      "pytest": pytest.__version__,
+      "plugin": pytest_doctest_custom.__version__,
+      "modules": args.modules,
+      "docstrings": args.docstrings,
+      "examples": args.examples,
+      "shapes": args.shapes,
+      "repeat": args.repeat,
+      "results": results,
+    }
+    if args.small_docstrings:
+        report["runner"] = runner_benchmark(args.small_docstrings, args.repeat)
+    if args.proxy_writes:
+        report["proxy"] = proxy_benchmark(args.proxy_writes, args.repeat)
+    if args.formatter_calls:
+        report["formatters"] = formatter_benchmark(
+                                 args.formatters or FORMATTERS,
+                                 args.formatter_calls, args.repeat)
+    if args.globals_names:
+        report["globals"] = globals_benchmark(args.globals_names,
+                                              args.small_docstrings or 2000,
+                                              args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+# Plugin hooks, used only in the py.test subprocesses
+
+plugin_data = {"time": 0., "passed": 0, "failed": 0}
+
+def pytest_runtest_logreport(report):
+    if report.when == "call":
+        plugin_data["time"] += report.duration
+        plugin_data["passed" if report.passed else "failed"] += 1
+
+def pytest_unconfigure(config):
+    output_name = os.environ.get(OUTPUT_ENV)
+    if output_name:
+        try:
+            import resource
+            rusage = resource.getrusage(resource.RUSAGE_SELF)
+            plugin_data["peak_rss_kib"] = rusage.ru_maxrss
+        except ImportError: # Not available on Windows
+            plugin_data["peak_rss_kib"] = None
+        with open(output_name, "w") as f:
+            json.dump(plugin_data, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 """Py.test doctest custom plugin"""
 # By Danilo J. S. Bellini
-import sys, functools, pytest
+import sys, os, functools, hashlib, marshal, threading, contextlib, pytest
 
 __version__ = "1.1.0.dev"
 
@@ -14,13 +14,392 @@ try:
 except ImportError:
     def import_module(module_name):
         return __import__(module_name, fromlist=module_name.split(".")[:-1])
+try:
+    from collections import OrderedDict # Python 2.7+
+except ImportError:
+    OrderedDict = dict # Arbitrary (not LRU) eviction order
+try:
+    string_types = basestring, # Python 2
+    scalar_types = type(None), bool, int, long, float, complex, str, unicode
+except NameError:
+    string_types = str,
+    scalar_types = type(None), bool, int, float, complex, str, bytes
+try:
+    hookwrapper = pytest.hookimpl(hookwrapper=True) # py.test 2.8+
+    tryfirst = pytest.hookimpl(tryfirst=True)
+except AttributeError:
+    hookwrapper = pytest.mark.hookwrapper # A no-op mark before py.test 2.7
+    tryfirst = pytest.mark.tryfirst
+has_hookwrappers = tuple(map(int, pytest.__version__.split(".")[:2])) \
+                   >= (2, 7)
+try:
+    firstresult = pytest.hookspec(firstresult=True) # py.test 2.8+
+except AttributeError:
+    def firstresult(func):
+        func.firstresult = True
+        return func
+try:
+    from time import perf_counter_ns as clock_ns # Python 3.7+
+except ImportError:
+    from timeit import default_timer
+    def clock_ns():
+        return int(default_timer() * 1e9)
 
 def printer(value):
     """Prints the object representation using the given custom formatter."""
     if value is not None:
-        representation = printer.repr(value)
-        if representation is not None: # Formatter or standard output printer?
-            print(representation)
+        timer = printer.timer
+        if timer is None:
+            printer.show(value)
+        else:
+            start = clock_ns()
+            length = printer.show(value)
+            timer.record(start, value, length)
+
+printer.timer = printer.limits = None
+
+def display(value):
+    """
+    Prints the value representation, returning its length (None when the
+    formatter is a printer that wrote it on its own).
+    """
+    representation = printer.repr(value)
+    if is_iterator(representation): # Streaming formatter
+        return print_chunks(representation)
+    elif representation is not None: # Formatter or stdout printer?
+        print(representation)
+        if isinstance(representation, string_types):
+            return len(representation)
+
+def display_limited(value):
+    """
+    Prints the value representation like ``display``, but through a
+    ``LimitedStream`` with the ``printer.limits`` (max bytes, max lines),
+    which stops printers and streaming formatters as soon as a limit is
+    exceeded. In that case, an elision marker is printed after the allowed
+    output prefix, and an ``OutputLimitError`` is raised.
+    """
+    stream = LimitedStream(sys.stdout, *printer.limits)
+    with redirect_stdout(stream):
+        try:
+            return display(value)
+        except OutputLimitError as exc:
+            stream.stream.write("\n<doctest-repr output elided>\n")
+            raise OutputLimitError("the {0} representation exceeds the {1} "
+                                   "limit".format(type(value).__name__, exc))
+
+def display_buffered(value):
+    """
+    Prints the value representation like ``display`` (or like
+    ``display_limited``), but batching all the writes in a single one.
+    """
+    stream = BufferedStream(sys.stdout)
+    with redirect_stdout(stream):
+        try:
+            if printer.limits is None:
+                return display(value)
+            return display_limited(value)
+        finally:
+            stream.flush_buffer()
+
+printer.show = display
+
+@contextlib.contextmanager
+def redirect_stdout(stream):
+    """
+    Context manager that redirects both the ``sys.stdout`` and the
+    ``stdout_proxy`` (in the current context/thread) to the given stream.
+    """
+    backup = sys.stdout
+    if backup is not stdout_proxy: # Not in the context local mode
+        sys.stdout = stream
+    token = stdout_proxy.bind(stream)
+    try:
+        yield stream
+    finally:
+        stdout_proxy.unbind(token)
+        sys.stdout = backup
+
+def is_iterator(obj):
+    """Tells whether the object is an iterator (e.g. a generator)."""
+    return hasattr(obj, "__next__") or hasattr(obj, "next")
+
+def current_example():
+    """
+    The ``(runner, example)`` pair of the doctest example being run, taken
+    from the ``DocTestRunner.__run`` frame locals, or ``(None, None)``
+    when called outside a doctest run.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_name == "__run" and "example" in frame.f_locals:
+            return frame.f_locals["self"], frame.f_locals["example"]
+        frame = frame.f_back
+    return None, None
+
+def print_chunks(chunks, margin=80):
+    """
+    Prints the chunks yielded by a streaming formatter, stopping it as soon
+    as the output can't match the expected output of the doctest example
+    anymore. Only the chunk prefix up to ``margin`` characters after the
+    expected output length is printed in that case, followed by a marker.
+    A line break is printed after the chunks unless the last one ends with
+    it. Returns the length of the printed representation.
+    """
+    runner, example = current_example()
+    if example is None:
+        checker = None
+    else:
+        checker = StreamChecker(example.want, runner.optionflags)
+        checker.feed(getattr(sys.stdout, "getvalue", str)()) # Prior output
+    length = 0
+    chunk = ""
+    for chunk in chunks:
+        if checker is None or checker.feed(chunk):
+            sys.stdout.write(chunk)
+            length += len(chunk)
+        else:
+            sys.stdout.write(chunk[:max(len(checker.want) - checker.pos, 0)
+                                   + margin])
+            print("\n<doctest-repr stream stopped: "
+                  "the output differs from the expected one>")
+            getattr(chunks, "close", str)()
+            return length
+    if not chunk.endswith("\n"):
+        print("")
+    return length
+
+class StreamChecker(object):
+    """
+    Incremental comparison of output chunks against the expected output of
+    a doctest example, aware of the ELLIPSIS and NORMALIZE_WHITESPACE option
+    flags. The ``feed`` method returns False only when the output can't
+    match anymore, regardless of the chunks yet to come. Unsupported cases
+    (``<BLANKLINE>``, ``True`` for ``1``, custom option flags) aren't
+    checked at all.
+    """
+    def __init__(self, want, optionflags):
+        import doctest
+        self.active = not (
+          optionflags & ~(doctest.COMPARISON_FLAGS | doctest.REPORTING_FLAGS)
+          or doctest.BLANKLINE_MARKER in want
+          or want.strip() in ("0", "1", "True", "False")
+        )
+        self.normalize = optionflags & doctest.NORMALIZE_WHITESPACE
+        if self.normalize:
+            want = " ".join(want.split())
+        self.prefix_only = optionflags & doctest.ELLIPSIS and \
+                           doctest.ELLIPSIS_MARKER in want
+        if self.prefix_only: # Only the text before the 1st ellipsis matters
+            want = want.split(doctest.ELLIPSIS_MARKER)[0]
+            if self.normalize: # Its last token might be a partial one
+                want = want.rpartition(" ")[0]
+        self.want = want
+        self.pos = 0 # Index of the next character to compare in want
+        self.tail = "" # Unfinished last token, for NORMALIZE_WHITESPACE
+
+    def feed(self, chunk):
+        if not self.active:
+            return True
+        if self.normalize:
+            return self.feed_tokens(chunk)
+        end = self.pos + len(chunk)
+        expected = self.want[self.pos:end]
+        if chunk == expected:
+            self.pos = end
+            if self.prefix_only and end >= len(self.want):
+                self.active = False
+            return True
+        index = len(expected)
+        for idx, (got_char, want_char) in enumerate(zip(chunk, expected)):
+            if got_char != want_char:
+                index = idx
+                break
+        # Whitespace-only lines might still be taken as blank lines
+        if (self.prefix_only and index == len(expected)) or \
+           chunk[index] in " \t\r\f\v":
+            self.active = False
+            return True
+        return False
+
+    def feed_tokens(self, chunk):
+        text = self.tail + chunk
+        tokens = text.split()
+        self.tail = tokens.pop() if tokens and not text[-1].isspace() else ""
+        for token in tokens:
+            if self.prefix_only and self.pos >= len(self.want):
+                self.active = False
+                return True
+            end = self.pos + len(token)
+            if self.want[self.pos:end] != token or \
+               self.want[end:end + 1] not in ("", " "):
+                return False
+            self.pos = end + 1
+        if self.prefix_only and self.pos >= len(self.want):
+            self.active = False
+            return True
+        return self.want[self.pos:self.pos + len(self.tail)] == self.tail
+
+class OutputLimitError(Exception):
+    """Output beyond the ``--doctest-repr-max-*`` limits."""
+
+class LimitedStream(object):
+    """
+    Stream wrapper that writes up to ``max_bytes`` bytes (of the UTF-8
+    encoded text) and ``max_lines`` lines (None for no limit), raising an
+    ``OutputLimitError`` after writing the allowed prefix of the data
+    beyond these limits, cut at a character boundary.
+    """
+    def __init__(self, stream, max_bytes=None, max_lines=None):
+        self.stream = stream
+        self.max_bytes = self.bytes_left = max_bytes
+        self.max_lines = self.lines_left = max_lines
+
+    def __getattr__(self, attr_name):
+        return getattr(self.stream, attr_name)
+
+    def write(self, data):
+        size = cut = len(data)
+        limit = None
+        if self.bytes_left is not None and \
+           encoded_size(data) > self.bytes_left:
+            cut = self.bytes_left
+            if not isinstance(data, bytes): # Drop a partial character
+                cut = len(data.encode("utf-8")[:cut]
+                              .decode("utf-8", "ignore"))
+            limit = "--doctest-repr-max-bytes={0}".format(self.max_bytes)
+        if self.lines_left is not None: # Cut after the last allowed line
+            pos = 0
+            for unused in range(self.lines_left):
+                pos = data.find("\n", pos, cut) + 1
+                if not pos:
+                    break
+            else:
+                if pos < cut:
+                    cut = pos
+                    limit = "--doctest-repr-max-lines={0}".format(
+                              self.max_lines)
+        self.stream.write(data[:cut])
+        if self.bytes_left is not None:
+            self.bytes_left -= encoded_size(data[:cut])
+        if self.lines_left is not None:
+            self.lines_left -= data.count("\n", 0, cut)
+        if cut < size:
+            raise OutputLimitError(limit)
+
+def encoded_size(data):
+    """Size in bytes of the data, encoding it to UTF-8 when it's text."""
+    return len(data if isinstance(data, bytes) else data.encode("utf-8"))
+
+class BufferedStream(object):
+    """Stream wrapper that batches the writes until ``flush_buffer``."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+        self.write = self.chunks.append
+
+    def __getattr__(self, attr_name):
+        return getattr(self.stream, attr_name)
+
+    def flush_buffer(self):
+        if self.chunks:
+            self.stream.write("".join(self.chunks))
+            del self.chunks[:]
+
+    def flush(self):
+        self.flush_buffer()
+        self.stream.flush()
+
+class ReprTimeoutError(Exception):
+    """Representation that took longer than the timeout."""
+
+class ReprTimeout(object):
+    """
+    Display function wrapper that stops the wrapped one when it takes more
+    than the given number of seconds, raising a ``ReprTimeoutError``. On
+    the main thread, that's done with a ``SIGALRM`` interval timer, unless
+    there's another one running. Otherwise, a timer thread raises the
+    exception asynchronously in the displaying thread (CPython only). In
+    both cases, it's raised only while running Python code, so a call to a
+    C function that never returns can't be stopped.
+    """
+    def __init__(self, show, seconds):
+        self.show = show
+        self.seconds = seconds
+
+    def __call__(self, value):
+        import signal
+        start = clock_ns()
+        try:
+            if hasattr(signal, "setitimer") and \
+               not signal.getitimer(signal.ITIMER_REAL)[0]:
+                try:
+                    backup = signal.signal(signal.SIGALRM, alarm_handler)
+                except ValueError: # Not in the main thread
+                    pass
+                else:
+                    return self.alarm_call(signal, backup, value)
+            return self.thread_call(value)
+        except ReprTimeoutError:
+            raise ReprTimeoutError("the {0} representation took {1:.3f}s, "
+                                   "exceeding the {2}s timeout".format(
+                                     type(value).__name__,
+                                     (clock_ns() - start) * 1e-9,
+                                     self.seconds))
+
+    def alarm_call(self, signal, backup, value):
+        try:
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
+            try:
+                return self.show(value)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        finally:
+            signal.signal(signal.SIGALRM, backup)
+
+    def thread_call(self, value):
+        set_async_exc = async_exc_setter()
+        if set_async_exc is None:
+            return self.show(value)
+        thread_id = threading.current_thread().ident
+        lock = threading.Lock()
+        state = ["running"]
+        def interrupt():
+            with lock:
+                if state[0] == "running":
+                    state[0] = "fired"
+                    set_async_exc(thread_id, ReprTimeoutError)
+        timer = threading.Timer(self.seconds, interrupt)
+        timer.daemon = True
+        timer.start()
+        try:
+            return self.show(value)
+        finally:
+            timer.cancel()
+            with lock:
+                if state[0] == "fired": # Clear it when it wasn't raised yet
+                    set_async_exc(thread_id, None)
+                state[0] = "finished"
+
+def alarm_handler(signum, frame):
+    """Signal handler for the ``ReprTimeout`` alarm."""
+    raise ReprTimeoutError
+
+def async_exc_setter():
+    """
+    Gets a ``set_async_exc(thread_id, exc_type)`` function that raises an
+    exception (or cancels a pending one, if ``exc_type`` is None) in the
+    given thread, or None if that's not available (not on CPython).
+    """
+    try:
+        import ctypes
+        func = ctypes.pythonapi.PyThreadState_SetAsyncExc
+    except (ImportError, AttributeError):
+        return None
+    def set_async_exc(thread_id, exc_type):
+        func(ctypes.c_ulong(thread_id),
+             None if exc_type is None else ctypes.py_object(exc_type))
+    return set_async_exc
 
 def temp_replace(obj, attr_name, value):
     """
@@ -62,28 +441,129 @@ class PluginError(pytest.UsageError):
         msg = "[{0}] {1}".format(type(exc).__name__, exc)
         super(PluginError, self).__init__(msg)
 
+class ContextLocal(object):
+    """
+    Value bound to the current context (``contextvars``, Python 3.7+) or
+    to the current thread, None when unbound.
+    """
+    def __init__(self, name):
+        try:
+            from contextvars import ContextVar
+        except ImportError:
+            self._var = None
+            self._local = threading.local()
+        else:
+            self._var = ContextVar(name, default=None)
+            self.get = self._var.get # Faster, as it's called on every write
+
+    def get(self):
+        if self._var is None:
+            return getattr(self._local, "value", None)
+        return self._var.get()
+
+    def bind(self, value):
+        """Binds the value, returning the token to be used to unbind it."""
+        if self._var is None:
+            token = self.get()
+            self._local.value = value
+            return token
+        return self._var.set(value)
+
+    def unbind(self, token):
+        if self._var is None:
+            self._local.value = token
+        else:
+            self._var.reset(token)
+
+class ContextFormatter(ContextLocal):
+    """Formatter that calls the one bound to the current context/thread."""
+    def __call__(self, value):
+        return (self.get() or repr)(value)
+
 class StandardStreamProxy(object):
     """
     Proxy class that grants deferred access to stream objects like
-    ``sys.stdout``, allowing the replacement of the underlying stream.
+    ``sys.stdout``, allowing the replacement of the underlying stream,
+    either process-wide or in the current context/thread (``bind``).
     """
     def __init__(self, name):
         self._name = name
+        self._local = ContextLocal(name)
+        self._cache = None, None # The (target, bound write method) pair
 
     def __getattr__(self, attr_name):
         return getattr(self.stream, attr_name)
 
+    def write(self, data):
+        """
+        Fast path for writing, calling the cached ``write`` bound method of
+        the stream, which is resolved again only when the target (either
+        the context bound stream or the ``sys`` stream) changes.
+        """
+        target = self._local.get()
+        if target is None:
+            target = getattr(sys, self._name)
+        cache = self._cache
+        if cache[0] is not target:
+            stream = target if target is not self else \
+                     getattr(sys, self._dname)
+            cache = self._cache = target, stream.write
+        return cache[1](data)
+
     @property
     def _dname(self): # sys dunder name (fallback to avoid a recursion cycle)
         return self._name.join(["__"] * 2)
 
     @property
     def stream(self):
+        obj = self._local.get()
+        if obj is not None:
+            return obj
         obj = getattr(sys, self._name)
         return obj if obj is not self else getattr(sys, self._dname)
 
+    def bind(self, stream):
+        """Routes the current context/thread accesses to the given stream."""
+        return self._local.bind(stream)
+
+    def unbind(self, token):
+        self._local.unbind(token)
+
 stdout_proxy = StandardStreamProxy("stdout")
 stderr_proxy = StandardStreamProxy("stderr")
+context_formatter = ContextFormatter("doctest_repr")
+
+class SharedReplace(object):
+    """
+    Reference counted context manager that replaces object attributes as
+    given by ``(obj, attr_name, value)`` triples, so concurrent runs share
+    a single replacement, the last one to leave restoring the attributes.
+    """
+    def __init__(self, *replacements):
+        self.replacements = replacements
+        self.backup = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            if not self.count:
+                for obj, attr_name, value in self.replacements:
+                    self.backup.append((obj, attr_name,
+                                        getattr(obj, attr_name, self)))
+                    setattr(obj, attr_name, value)
+            self.count += 1
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.count -= 1
+            if not self.count:
+                for obj, attr_name, value in reversed(self.backup):
+                    if value is self: # There was no such attribute
+                        delattr(obj, attr_name)
+                    else:
+                        setattr(obj, attr_name, value)
+                del self.backup[:]
 
 @temp_replace(sys, "stdout", stdout_proxy) # For import time assignments
 @temp_replace(sys, "stderr", stderr_proxy)
@@ -105,34 +585,1880 @@ def parse_address(address):
         module = builtins
     return functools.reduce(getattr, func_name.split("."), module)
 
+@replace_exception(ValueError, PluginError)
+def parse_type_entry(entry):
+    """
+    Gets the ``(type, formatter)`` pair from a ``TYPE=FORMATTER`` string,
+    where both are addresses as in ``parse_address``.
+    """
+    type_address, sep, address = entry.partition("=")
+    if not sep:
+        raise ValueError("Missing '=' in doctest-repr-type entry")
+    return parse_address(type_address.strip()), parse_address(address.strip())
+
+class TypeDispatcher(object):
+    """
+    Formatter that calls another formatter chosen by the value type from a
+    ``{type: formatter}`` table, looking for the nearest type in the method
+    resolution order, then for the first (abstract) base class in the table
+    order, falling back to the default formatter. The chosen formatter is
+    cached for each concrete type, so the lookup happens only once.
+    """
+    def __init__(self, default, table):
+        self.default = default
+        self.table = table
+        self.cache = dict(table)
+
+    def __call__(self, value):
+        cls = type(value)
+        try:
+            func = self.cache[cls]
+        except KeyError:
+            func = self.cache[cls] = self.lookup(cls)
+        return func(value)
+
+    def lookup(self, cls):
+        for base in getattr(cls, "__mro__", ()):
+            if base in self.table:
+                return self.table[base]
+        for base in self.table:
+            try:
+                if issubclass(cls, base):
+                    return self.table[base]
+            except TypeError:
+                pass
+        return self.default
+
+PRETTY_BRACKETS = OrderedDict([
+  (dict, ("{", "}", "{}")),
+  (list, ("[", "]", "[]")),
+  (tuple, ("(", ")", "()")),
+  (set, ("{", "}", "set()")),
+  (frozenset, ("frozenset({", "})", "frozenset()")),
+])
+
+def pretty_base(value):
+    """
+    The built-in container type of the value (also for subclasses that
+    don't override ``__repr__``), or None.
+    """
+    cls = type(value)
+    if cls in PRETTY_BRACKETS:
+        return cls
+    for base in PRETTY_BRACKETS:
+        if isinstance(value, base) and cls.__repr__ is base.__repr__:
+            return base
+    return None
+
+def sorted_items(items):
+    """
+    Sorts the items for a deterministic output, by their type and their
+    ``pretty`` representation when they can't be compared with each other
+    or when they have sets (whose comparison is just a partial order, the
+    subset relation, so sorting them would keep their hash order).
+    """
+    if not any(map(has_set, items)):
+        try:
+            return sorted(items)
+        except TypeError:
+            pass
+    return sorted(items, key=lambda item: (type(item).__module__,
+                                           type(item).__name__,
+                                           pretty(item)))
+
+def has_set(value):
+    """Tells whether the value is a set or a tuple with sets in it."""
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (set, frozenset)):
+            return True
+        if isinstance(value, tuple):
+            stack.extend(value)
+    return False
+
+def pretty(value, max_width=79):
+    """
+    Deterministic representation formatter using only the standard
+    library: dict keys, sets and frozensets are sorted like in the IPython
+    ``pretty``, and a container that doesn't fit in the rest of the line
+    is split in one item per line, aligned after its opening bracket (also
+    when nested in a dict, unlike the IPython single space indent). Only
+    the built-in containers are split, other values are shown with
+    ``repr``. It's iterative, so deeply nested values don't reach the
+    recursion limit, and the output is written in a single buffer.
+    """
+    # Builds the [open, close, sep, items, width, breakable] node tree,
+    # where the leaves are strings and the dict items are unbreakable
+    # key-value nodes, computing the single line width of every node
+    root = [None]
+    ancestors = set()
+    stack = [(value, root, 0)]
+    while stack:
+        obj, items, idx = stack.pop()
+        if items is None: # All items of the obj node were built
+            node, obj_id = obj
+            ancestors.discard(obj_id)
+            node[4] = len(node[0]) + len(node[1]) + \
+                      len(node[2]) * (len(node[3]) - 1) + \
+                      sum(item[4] if type(item) is list else len(item)
+                          for item in node[3])
+            continue
+        base = pretty_base(obj)
+        if base is None:
+            items[idx] = repr(obj)
+            continue
+        open_, close, empty = PRETTY_BRACKETS[base]
+        if not obj:
+            items[idx] = empty
+        elif id(obj) in ancestors: # Recursive container
+            items[idx] = open_ + "..." + close
+        else:
+            if base is tuple and len(obj) == 1:
+                close = ",)"
+            node = items[idx] = [open_, close, ", ", [None] * len(obj), 0,
+                                 True]
+            ancestors.add(id(obj))
+            stack.append(((node, id(obj)), None, 0))
+            if base is dict:
+                for pos, key in reversed(list(enumerate(sorted_items(obj)))):
+                    pair = node[3][pos] = ["", "", ": ", [None, None], 0,
+                                           False]
+                    stack.append(((pair, None), None, 0))
+                    for child, pos in [(obj[key], 1), (key, 0)]:
+                        if type(child) in scalar_types: # Shortcut
+                            pair[3][pos] = repr(child)
+                        else:
+                            stack.append((child, pair[3], pos))
+            else:
+                children = obj if base in (list, tuple) else sorted_items(obj)
+                for pos in reversed(range(len(children))):
+                    child = children[pos]
+                    if type(child) in scalar_types: # Shortcut
+                        node[3][pos] = repr(child)
+                    else:
+                        stack.append((child, node[3], pos))
+
+    # Renders the nodes, where the trail is the width of the text that
+    # has to be in the same line after the node (e.g. closing brackets)
+    parts = []
+    column = 0
+    stack = [(root[0], 0, False)] # Strings are written as they are
+    while stack:
+        task = stack.pop()
+        if type(task) is tuple:
+            node, trail, flat = task
+            if type(node) is list:
+                open_, close, sep, items, width, breakable = node
+                last = len(items) - 1
+                if flat or column + width + trail <= max_width:
+                    if all(type(item) is not list for item in items):
+                        stack.append(open_ + sep.join(items) + close)
+                        continue
+                    tasks = [open_]
+                    for pos, item in enumerate(items):
+                        tasks.append((item, 0, True))
+                        if pos != last:
+                            tasks.append(sep)
+                elif not breakable: # A dict key-value pair
+                    tasks = [open_, (items[0], len(sep), False), sep,
+                             (items[1], trail, False)]
+                else:
+                    line_sep = sep.rstrip() + "\n" + \
+                               " " * (column + len(open_))
+                    tasks = [open_]
+                    for pos, item in enumerate(items):
+                        if type(item) is not list: # Leaf
+                            tasks.append(item)
+                        elif pos == last:
+                            tasks.append((item, len(close) + trail, False))
+                        else:
+                            tasks.append((item, len(sep.rstrip()), False))
+                        if pos != last:
+                            tasks.append(line_sep)
+                tasks.append(close)
+                stack.extend(reversed(tasks))
+                continue
+            task = node
+        parts.append(task)
+        newline = task.rfind("\n")
+        if newline < 0:
+            column += len(task)
+        else:
+            column = len(task) - newline - 1
+    return "".join(parts)
+
+class NDArrayFormatter(object):
+    """
+    Representation formatter for NumPy arrays with fixed print options
+    (precision, line width, summarization threshold and edge items, the
+    other ones pinned to their NumPy defaults), so only the leading and
+    trailing items of large arrays are formatted, and the result doesn't
+    depend on the global NumPy print options. Arrays are detected by duck
+    typing, without importing NumPy. Other values are sent to the fallback
+    formatter, given either as a callable or as a ``--doctest-repr``
+    address (resolved when first needed).
+    """
+    # The floatmode, sign and legacy options are missing before NumPy 1.14
+    default_options = dict(suppress=False, nanstr="nan", infstr="inf",
+                           formatter=None, floatmode="maxprec", sign="-",
+                           legacy=False)
+
+    def __init__(self, fallback=repr, precision=8, linewidth=75,
+                 threshold=1000, edgeitems=3):
+        self.fallback = fallback
+        self.options = dict(precision=precision, linewidth=linewidth,
+                            threshold=threshold, edgeitems=edgeitems)
+
+    def __call__(self, value):
+        cls = type(value)
+        if hasattr(cls, "__array__") and hasattr(cls, "dtype") and \
+           hasattr(cls, "shape"):
+            numpy = sys.modules.get("numpy")
+            if numpy is not None and isinstance(value, numpy.ndarray):
+                return self.format(numpy, value)
+        if isinstance(self.fallback, string_types):
+            self.fallback = parse_address(self.fallback)
+        return self.fallback(value)
+
+    def format(self, numpy, array):
+        backup = numpy.get_printoptions()
+        options = dict((name, value)
+                       for name, value in self.default_options.items()
+                       if name in backup)
+        options.update(self.options)
+        printoptions = getattr(numpy, "printoptions", None) # NumPy 1.15+
+        if printoptions is not None:
+            with printoptions(**options):
+                return numpy.array_repr(array)
+        numpy.set_printoptions(**options)
+        try:
+            return numpy.array_repr(array)
+        finally:
+            numpy.set_printoptions(**backup)
+
+ndarray_repr = NDArrayFormatter()
+
+class Uncacheable(Exception):
+    """Value whose representation can't be safely cached."""
+
+def fingerprint(value, max_items=10000, max_depth=32, unordered=False):
+    """
+    Hashable key that identifies a value by its type and contents, or
+    None if the value isn't safe to be used as a cache key (unknown types,
+    too many items or nesting levels). Only scalars and the built-in
+    containers are accepted (not their subclasses), and the container
+    items are kept in their iteration order, unless ``unordered`` is set,
+    which makes the dict, set and frozenset keys order independent.
+    """
+    budget = [max_items]
+    def key(obj, depth):
+        cls = type(obj)
+        budget[0] -= 1
+        if budget[0] < 0 or depth > max_depth:
+            raise Uncacheable(obj)
+        if cls is float or cls is complex: # As 0.0 == -0.0
+            return cls, repr(obj)
+        if cls in scalar_types:
+            return cls, obj
+        if cls is dict:
+            pairs = ((key(k, depth + 1), key(v, depth + 1))
+                     for k, v in obj.items())
+            return cls, frozenset(pairs) if unordered else tuple(pairs)
+        if unordered and cls in (set, frozenset):
+            return cls, frozenset(key(item, depth + 1) for item in obj)
+        if cls in (list, tuple, set, frozenset):
+            return cls, tuple(key(item, depth + 1) for item in obj)
+        raise Uncacheable(obj)
+    try:
+        return key(value, 0)
+    except Uncacheable:
+        return None
+
+class LiteralComparison(object):
+    """
+    Display function wrapper that compares the value with the expected
+    output of the doctest example when it's a Python literal, writing the
+    expected output itself when they're equal, so the wrapped display
+    function (and the formatter) is called only when they differ. The
+    comparison is strict about the types, like the ``fingerprint`` keys,
+    but dicts and sets are compared regardless of their order. Each
+    distinct expected output is parsed only once.
+    """
+    def __init__(self, show):
+        self.show = show
+        self.literals = {}
+
+    def __call__(self, value):
+        runner, example = current_example()
+        if example is not None and \
+           not getattr(sys.stdout, "getvalue", str)(): # No prior output
+            expected = self.literal(example.want)
+            if expected is not None and \
+               expected == fingerprint(value, sys.maxsize, unordered=True):
+                sys.stdout.write(example.want)
+                return len(example.want.rstrip("\n"))
+        return self.show(value)
+
+    def literal(self, want):
+        try:
+            return self.literals[want]
+        except KeyError:
+            pass
+        import ast
+        try:
+            expected = fingerprint(ast.literal_eval(want.strip()),
+                                   sys.maxsize, unordered=True)
+        except Exception: # Not a literal
+            expected = None
+        self.literals[want] = expected
+        return expected
+
+class ReprCache(object):
+    """
+    Bounded least recently used (LRU) cache in front of a representation
+    formatter, keyed by the SHA1 digest of the value ``fingerprint`` (and
+    of the formatter identity, unless it's the main one), so every key has
+    the same small size, which is counted with the representation size.
+    Only string results are stored, so printer callables are always called.
+    """
+    def __init__(self, func, maxsize, maxbytes):
+        self.func = func
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.data = OrderedDict()
+        self.nbytes = self.hits = self.misses = self.evictions = 0
+        self.bypasses = 0
+
+    def __call__(self, value):
+        return self.cached(self.func, value)
+
+    def cached(self, func, value):
+        """
+        Representation of the value from the given formatter, sharing
+        this cache with the main one (a per-directory formatter).
+        """
+        key = fingerprint(value)
+        if key is None:
+            self.bypasses += 1
+            return func(value)
+        if func is not self.func: # Formatters are kept alive by the config
+            key = id(func), key
+        key = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        try:
+            representation = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data[key] = representation # Now the most recently used
+            return representation
+        representation = func(value)
+        if isinstance(representation, string_types):
+            self.store(key, representation)
+        return representation
+
+    def store(self, key, representation):
+        size = sys.getsizeof(key) + sys.getsizeof(representation)
+        if size > self.maxbytes:
+            return
+        self.data[key] = representation
+        self.nbytes += size
+        while len(self.data) > self.maxsize or self.nbytes > self.maxbytes:
+            oldest_key = next(iter(self.data))
+            self.nbytes -= sys.getsizeof(oldest_key) + \
+                           sys.getsizeof(self.data.pop(oldest_key))
+            self.evictions += 1
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep("-", "doctest-repr cache")
+        terminalreporter.write_line(
+            "{0} hits, {1} misses, {2} evictions, {3} uncacheable "
+            "({4} entries, {5} bytes)".format(self.hits, self.misses,
+            self.evictions, self.bypasses, len(self.data), self.nbytes))
+
+class ReprDurations(object):
+    """
+    Plugin that collects the plugin printer timings for each doctest item,
+    reporting the items that spent the most time in the formatter, against
+    their total time (the whole ``pytest_runtest_call`` of the item). Only
+    the slowest call of each item is kept (its value type and output length).
+    """
+    def __init__(self, count):
+        self.count = count
+        self.items = []
+        self.reset()
+
+    def reset(self):
+        self.elapsed = self.calls = self.slowest = 0
+        self.slowest_type = self.slowest_length = None
+
+    def record(self, start, value, length):
+        duration = clock_ns() - start
+        self.elapsed += duration
+        self.calls += 1
+        if duration > self.slowest:
+            self.slowest = duration
+            self.slowest_type = type(value)
+            self.slowest_length = length
+
+    @hookwrapper
+    def pytest_runtest_call(self, item):
+        self.reset()
+        start = clock_ns()
+        yield
+        total = clock_ns() - start
+        if self.calls:
+            self.items.append((self.elapsed, total, self.calls, item.nodeid,
+                               self.slowest, self.slowest_type,
+                               self.slowest_length))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        items = sorted(self.items, key=lambda data: data[0], reverse=True)
+        if self.count:
+            items = items[:self.count]
+            title = "slowest {0} doctest-repr durations".format(self.count)
+        else:
+            title = "slowest doctest-repr durations"
+        terminalreporter.write_sep("-", title)
+        for elapsed, total, calls, nodeid, slowest, cls, length in items:
+            terminalreporter.write_line(
+                "{0:.6f}s formatter / {1:.6f}s total ({2} calls) {3}"
+                .format(elapsed * 1e-9, total * 1e-9, calls, nodeid))
+            terminalreporter.write_line(
+                "    slowest call: {0:.6f}s {1}.{2} -> {3} chars".format(
+                slowest * 1e-9, cls.__module__, cls.__name__,
+                "?" if length is None else length))
+
+class DoctestMemory(object):
+    """
+    Plugin that traces the memory allocated by each doctest run (with
+    ``tracemalloc``), reporting the doctest items with the highest peak,
+    and how much of that memory was retained after their run (when their
+    globals were already cleared), e.g. by caches or by leaked objects.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.items = []
+        self.peak = self.retained = 0
+
+    def run(self, run, runner, *args, **kwargs):
+        """
+        Calls ``run(runner, *args, **kwargs)``, the ``DocTestRunner.run``
+        method, tracing the memory it allocates.
+        """
+        import tracemalloc
+        owner = not tracemalloc.is_tracing()
+        if owner:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, "reset_peak"): # Python 3.9+
+            tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        try:
+            return run(runner, *args, **kwargs)
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            if owner:
+                tracemalloc.stop()
+            self.peak = max(self.peak, peak - start)
+            self.retained += current - start
+
+    @hookwrapper
+    def pytest_runtest_call(self, item):
+        self.peak = self.retained = 0
+        yield
+        if is_doctest(item):
+            self.items.append((self.peak, self.retained, item.nodeid))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        items = sorted(self.items, key=lambda data: data[0], reverse=True)
+        if self.count:
+            items = items[:self.count]
+            title = "largest {0} doctest memory peaks".format(self.count)
+        else:
+            title = "largest doctest memory peaks"
+        terminalreporter.write_sep("-", title)
+        for peak, retained, nodeid in items:
+            terminalreporter.write_line(
+                "{0:.1f} KiB peak, {1:.1f} KiB retained {2}".format(
+                peak / 1024., retained / 1024., nodeid))
+
+class GlobalsCleaner(object):
+    """
+    Plugin that clears the doctest globals right after the doctest item
+    teardown. That includes the globals of doctests that didn't run (e.g.
+    skipped or cached), as ``DocTestRunner.run`` only clears the globals
+    of the doctests it runs.
+    """
+    @hookwrapper
+    def pytest_runtest_teardown(self, item, nextitem):
+        yield
+        if is_doctest(item):
+            dtest = getattr(item, "dtest", None) # Not on py.test < 2.4
+            if dtest is not None:
+                dtest.globs.clear()
+
+class DoctestProfile(object):
+    """
+    Plugin that profiles the doctest items whose node ID matches a glob
+    pattern with ``cProfile``, writing a pstats file for each item and a
+    combined one in a directory. The time of each item is split in the
+    example code, the formatter (the plugin printer) and the doctest
+    machinery (compiling, output capture and comparison) buckets.
+    """
+    combined_name = "combined.pstats"
+
+    def __init__(self, pattern, path, count=10):
+        self.pattern = pattern
+        self.path = path
+        self.count = count
+        self.item = self.combined = None
+        self.items = []
+
+    def run(self, run, runner, *args, **kwargs):
+        """
+        Calls ``run(runner, *args, **kwargs)``, the ``DocTestRunner.run``
+        method, profiling it when the current item was selected.
+        """
+        if self.item is None:
+            return run(runner, *args, **kwargs)
+        import cProfile, pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return run(runner, *args, **kwargs)
+        finally:
+            profiler.disable()
+            stats = pstats.Stats(profiler)
+            self.record(stats)
+
+    def record(self, stats):
+        import re
+        code = printer.__code__
+        printer_key = code.co_filename, code.co_firstlineno, code.co_name
+        example = formatter = 0.
+        for key, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if key == printer_key:
+                formatter += ct
+            elif key[0].startswith("<doctest ") and key[2] == "<module>":
+                example += ct # Top level example code, not its functions
+        example -= formatter # The printer is called by the example code
+        total = stats.total_tt
+        self.items.append((total, example, formatter,
+                           total - example - formatter, self.item.nodeid))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        name = re.sub(r"[^\w.-]+", "_", self.item.nodeid) + ".pstats"
+        stats.dump_stats(os.path.join(self.path, name))
+        if self.combined is None:
+            self.combined = stats
+        else:
+            self.combined.add(stats)
+
+    @hookwrapper
+    def pytest_runtest_call(self, item):
+        import fnmatch
+        if is_doctest(item) and fnmatch.fnmatch(item.nodeid, self.pattern):
+            self.item = item
+        try:
+            yield
+        finally:
+            self.item = None
+
+    def pytest_sessionfinish(self, session):
+        if self.combined is not None:
+            self.combined.dump_stats(os.path.join(self.path,
+                                                  self.combined_name))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep("-", "doctest profile")
+        items = sorted(self.items, key=lambda data: data[0], reverse=True)
+        for total, example, formatter, machinery, nodeid in items:
+            terminalreporter.write_line(
+                "{0:.6f}s total: {1:.6f}s example code, {2:.6f}s formatter, "
+                "{3:.6f}s doctest {4}".format(total, example, formatter,
+                                              machinery, nodeid))
+        if self.combined is None:
+            return
+        terminalreporter.write_line("hot functions (by own time):")
+        stats = self.combined.stats
+        hot = sorted(stats, key=lambda key: stats[key][2], reverse=True)
+        for filename, lineno, func_name in hot[:self.count]:
+            cc, nc, tt, ct, callers = stats[filename, lineno, func_name]
+            terminalreporter.write_line(
+                "    {0:.6f}s {1} calls {2}:{3}({4})".format(
+                tt, nc, filename, lineno, func_name))
+        terminalreporter.write_line("pstats files written to {0}".format(
+                                    self.path))
+
+class AsyncLoops(object):
+    """
+    Plugin that runs the doctest examples with a top-level ``await`` (or
+    ``async for``/``async with``) on an asyncio event loop that's created
+    on demand and shared by the examples of a docstring or of a module,
+    reporting the loop setup and teardown times.
+    """
+    helper_name = "__doctest_await__"
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.count = self.setup_time = self.teardown_time = 0
+
+    def open(self):
+        import asyncio
+        start = clock_ns()
+        loop = asyncio.new_event_loop()
+        self.setup_time += clock_ns() - start
+        self.count += 1
+        return loop
+
+    def close(self, runner):
+        loop = getattr(runner, "_doctest_loop", None)
+        if loop is not None:
+            runner._doctest_loop = None
+            start = clock_ns()
+            try:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                loop.close()
+            self.teardown_time += clock_ns() - start
+
+    def run(self, runner, run, test, compileflags, out):
+        """
+        Calls ``run(runner, test, compileflags, out)``, the doctest runner
+        ``__run`` method, with the examples that need an event loop
+        temporarily replaced by a call to a helper that awaits them.
+        """
+        import ast, inspect
+        flags = compileflags | ast.PyCF_ALLOW_TOP_LEVEL_AWAIT
+        codes, sources = [], []
+        for idx, example in enumerate(test.examples):
+            if "await" not in example.source and \
+               "async" not in example.source:
+                continue
+            filename = "<doctest {0}[{1}]>".format(test.name, idx)
+            try:
+                code = compile(example.source, filename, "single", flags, True)
+            except SyntaxError: # Reported by the doctest runner itself
+                continue
+            if code.co_flags & inspect.CO_COROUTINE:
+                sources.append((example, example.source))
+                example.source = "{0}({1})\n".format(self.helper_name,
+                                                      len(codes))
+                codes.append(code)
+        if not codes:
+            return run(runner, test, compileflags, out)
+
+        def await_example(idx):
+            loop = getattr(runner, "_doctest_loop", None)
+            if loop is None:
+                loop = runner._doctest_loop = self.open()
+            return loop.run_until_complete(eval(codes[idx], test.globs))
+
+        test.globs[self.helper_name] = await_example
+        try:
+            return run(runner, test, compileflags, out)
+        finally:
+            test.globs.pop(self.helper_name, None)
+            for example, source in sources:
+                example.source = source
+            if self.scope == "docstring":
+                self.close(runner)
+
+    def pytest_runtest_teardown(self, item, nextitem):
+        runner = getattr(item, "runner", None)
+        if runner is not None and getattr(nextitem, "runner", None) \
+                                  is not runner: # Last item of the module
+            self.close(runner)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep("-", "doctest async loops")
+        terminalreporter.write_line(
+            "{0} event loops, {1:.6f}s setup, {2:.6f}s teardown".format(
+            self.count, self.setup_time * 1e-9, self.teardown_time * 1e-9))
+
+class ExampleCache(object):
+    """
+    Plugin that stores the parsed doctest examples (by docstring) and their
+    compiled code objects (by source, file name and compiler flags) in the
+    py.test cache directory as a marshal file, like ``__pycache__`` does for
+    modules, so unchanged docstrings aren't parsed nor compiled again.
+    Each session that changes the cache is a new generation, and the
+    entries not used in the last ``max_age`` generations are dropped.
+    """
+    cache_name = "doctest_custom"
+    file_name = "examples.marshal"
+    max_age = 10
+
+    def __init__(self, config, clear=False):
+        self.config = config
+        self.version = " ".join([sys.version, __version__])
+        self.data = None if clear else self.load()
+        if not self.data or self.data.get("version") != self.version or \
+           "used" not in self.data:
+            self.data = {"version": self.version, "parse": {}, "code": {},
+                         "generation": 0, "used": {}}
+        self.used = set() # Keys used in this session
+        self.changed = False
+        self.parse_hits = self.parse_misses = 0
+        self.compile_hits = self.compile_misses = 0
+        self.replace = None
+
+    @property
+    def path(self):
+        cache = self.config.cache
+        mkdir = getattr(cache, "mkdir", None) or cache.makedir
+        return os.path.join(str(mkdir(self.cache_name)), self.file_name)
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                return marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def key(self, *parts):
+        text = "\0".join(map(str, parts))
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def parse(self, parse, parser, string, name="<string>"):
+        """Cached ``parse(parser, string, name)``, a DocTestParser call."""
+        import doctest
+        key = self.key(string)
+        self.used.add(key)
+        cached = self.data["parse"].get(key)
+        if cached is None:
+            self.parse_misses += 1
+            result = parse(parser, string, name)
+            self.data["parse"][key] = [
+              item if isinstance(item, string_types) else
+              (item.source, item.want, item.exc_msg, item.lineno, item.indent,
+               item.options)
+              for item in result
+            ]
+            self.changed = True
+            return result
+        self.parse_hits += 1
+        return [item if isinstance(item, string_types) else
+                doctest.Example(*item) for item in cached]
+
+    def compile(self, source, filename, mode, flags=0, dont_inherit=False):
+        """Cached built-in ``compile``, for the doctest examples."""
+        key = self.key(source, filename, mode, flags, dont_inherit)
+        self.used.add(key)
+        code = self.data["code"].get(key)
+        if code is None:
+            self.compile_misses += 1
+            code = compile(source, filename, mode, flags, dont_inherit)
+            self.data["code"][key] = code
+            self.changed = True
+        else:
+            self.compile_hits += 1
+        return code
+
+    def compile_replace(self):
+        """Shared replacement of ``doctest.compile`` for the runners."""
+        if self.replace is None:
+            import doctest
+            self.replace = SharedReplace((doctest, "compile", self.compile))
+        return self.replace
+
+    @hookwrapper
+    def pytest_make_collect_report(self, collector):
+        from _pytest.doctest import DoctestModule, DoctestTextfile
+        if isinstance(collector, (DoctestModule, DoctestTextfile)):
+            import doctest
+            parse = doctest.DocTestParser.parse
+            doctest.DocTestParser.parse = lambda parser, *args, **kwargs: \
+                                          self.parse(parse, parser,
+                                                     *args, **kwargs)
+            try:
+                yield
+            finally:
+                doctest.DocTestParser.parse = parse
+        else:
+            yield
+
+    def prune(self):
+        """Starts a new generation, dropping the entries too old."""
+        generation = self.data["generation"] = self.data["generation"] + 1
+        used = self.data["used"]
+        used.update(dict.fromkeys(self.used, generation))
+        for section in ("parse", "code"):
+            entries = self.data[section]
+            for key in list(entries):
+                if used.get(key, 0) <= generation - self.max_age:
+                    del entries[key]
+                    used.pop(key, None)
+
+    def pytest_sessionfinish(self, session):
+        if self.changed: # Write then rename, for pytest-xdist workers
+            self.prune()
+            path = self.path
+            temp_path = "{0}.{1}".format(path, os.getpid())
+            with open(temp_path, "wb") as f:
+                marshal.dump(self.data, f)
+            if os.path.exists(path) and sys.platform.startswith("win"):
+                os.remove(path)
+            os.rename(temp_path, path)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep("-", "doctest example cache")
+        terminalreporter.write_line(
+            "parse: {0} hits, {1} misses; compile: {2} hits, {3} misses"
+            .format(self.parse_hits, self.parse_misses,
+                    self.compile_hits, self.compile_misses))
+
+def scan_examples(source):
+    """
+    Tells whether the Python source code (bytes) might have doctest
+    examples, i.e., whether some string has a ``>>>`` prompt or the module
+    might create its docstrings dynamically (e.g. assigning ``__doc__``,
+    with ``__test__`` or ``functools.wraps``). Without tokenizing the code
+    when none of these substrings are found.
+    """
+    import tokenize
+    from io import BytesIO
+    names = StaticIndex.fallback_names
+    if b">>>" not in source and \
+       not any(name.encode("ascii") in source for name in names):
+        return False
+    readline = BytesIO(source).readline
+    try:
+        if sys.version_info[0] >= 3:
+            tokens = list(tokenize.tokenize(readline))
+        else:
+            tokens = list(tokenize.generate_tokens(readline))
+    except Exception: # Let the import report the syntax errors
+        return True
+    for token in tokens:
+        token_type, text = token[:2]
+        if token_type == tokenize.COMMENT:
+            continue
+        if ">>>" in text or (token_type == tokenize.NAME and text in names):
+            return True
+        if token_type == tokenize.STRING and \
+           any(name in text for name in names if name.startswith("__")):
+            return True # E.g. setattr(obj, "__doc__", ...)
+    return False
+
+class StaticIndex(object):
+    """
+    Plugin that prevents importing the modules that can't have doctest
+    examples, according to ``scan_examples``, keeping an index of the scan
+    results in the py.test cache, checked by the file modification time,
+    size and SHA1 hash. The collection time of the skipped modules is
+    known only when they had been collected in some previous run.
+    """
+    cache_name = "doctest_custom/static_index"
+    fallback_names = frozenset(["__doc__", "__test__", "wraps",
+                                "update_wrapper"])
+
+    def __init__(self, config):
+        self.config = config
+        cache = getattr(config, "cache", None)
+        self.index = {} if cache is None else cache.get(self.cache_name, {})
+        self.changed = False
+        self.skipped = self.scan_time = 0
+        self.saved_time = 0.
+
+    def entry(self, path):
+        """Index entry [mtime, size, sha1, has_examples, collect_time]."""
+        stat = os.stat(path)
+        entry = self.index.get(path)
+        if entry and entry[:2] == [stat.st_mtime, stat.st_size]:
+            return entry
+        with open(path, "rb") as f:
+            source = f.read()
+        digest = hashlib.sha1(source).hexdigest()
+        if entry and entry[2] == digest:
+            entry[:2] = stat.st_mtime, stat.st_size
+        else: # The last known collection time is kept
+            entry = [stat.st_mtime, stat.st_size, digest,
+                     scan_examples(source), entry[4] if entry else None]
+        self.index[path] = entry
+        self.changed = True
+        return entry
+
+    def has_examples(self, path):
+        start = clock_ns()
+        try:
+            entry = self.entry(path)
+        finally:
+            self.scan_time += clock_ns() - start
+        if not entry[3]:
+            self.skipped += 1
+            self.saved_time += entry[4] or 0.
+        return entry[3]
+
+    @hookwrapper
+    def pytest_collect_file(self, parent):
+        outcome = yield
+        from _pytest.doctest import DoctestModule
+        collectors = outcome.get_result()
+        kept = [collector for collector in collectors
+                if not isinstance(collector, DoctestModule)
+                or self.has_examples(str(collector.fspath))]
+        if len(kept) < len(collectors):
+            outcome.force_result(kept)
+
+    @hookwrapper
+    def pytest_make_collect_report(self, collector):
+        from _pytest.doctest import DoctestModule
+        start = clock_ns()
+        yield
+        if isinstance(collector, DoctestModule):
+            entry = self.index.get(str(collector.fspath))
+            if entry is not None:
+                entry[4] = (clock_ns() - start) * 1e-9
+                self.changed = True
+
+    def pytest_sessionfinish(self, session):
+        cache = getattr(self.config, "cache", None)
+        if self.changed and cache is not None:
+            cache.set(self.cache_name, self.index)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep("-", "doctest static scan")
+        terminalreporter.write_line(
+            "{0} modules without examples not imported, saving {1:.6f}s "
+            "(known) in {2:.6f}s of scanning".format(
+            self.skipped, self.saved_time, self.scan_time * 1e-9))
+
+class LayeredGlobals(dict):
+    """
+    Doctest globals whose own (overlay) dictionary items are the ones set
+    by the doctest, falling back to the items of a shared and read-only
+    ``base`` dictionary, so copying it copies just the small overlay.
+    Deleted base keys are kept as tombstones. The overlay ``__builtins__``
+    is a ``LayeredBuiltins``, for the global name lookups where the
+    interpreter ignores ``__missing__`` (e.g. in class bodies).
+    """
+    def __init__(self, base, overlay=(), tombstones=()):
+        dict.__init__(self, overlay)
+        self.base = base
+        self.tombstones = set(tombstones)
+        if not dict.__contains__(self, "__builtins__"):
+            dict.__setitem__(self, "__builtins__",
+                             LayeredBuiltins(base, self.tombstones))
+
+    def __missing__(self, key):
+        if key in self.tombstones:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or \
+               (key in self.base and key not in self.tombstones)
+
+    def __delitem__(self, key):
+        if key in self.base and key not in self.tombstones:
+            dict.pop(self, key, None)
+            self.tombstones.add(key)
+        else:
+            dict.__delitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def merged(self):
+        """Plain dictionary with all the visible items."""
+        result = self.base.copy()
+        for key in self.tombstones:
+            result.pop(key, None)
+        result.update(dict.items(self))
+        return result
+
+    def __iter__(self):
+        return iter(self.merged())
+
+    def __len__(self):
+        return len(self.merged())
+
+    def __repr__(self):
+        return repr(self.merged())
+
+    def keys(self):
+        return self.merged().keys()
+
+    def values(self):
+        return self.merged().values()
+
+    def items(self):
+        return self.merged().items()
+
+    def copy(self):
+        overlay = dict(dict.items(self)) # Not dict.copy, as it calls keys
+        if isinstance(overlay.get("__builtins__"), LayeredBuiltins):
+            del overlay["__builtins__"]
+        return LayeredGlobals(self.base, overlay, self.tombstones)
+
+    def clear(self):
+        dict.clear(self)
+        self.tombstones.clear()
+
+class LayeredBuiltins(dict):
+    """
+    Built-ins namespace whose lookups fall back to the items of a
+    ``LayeredGlobals`` base dictionary (but its tombstones), then to the
+    actual built-ins. It starts with the built-ins not shadowed by the
+    base, as the interpreter looks some of them up (e.g. ``__import__``)
+    without calling ``__missing__``.
+    """
+    def __init__(self, base, tombstones):
+        self.base = base
+        self.tombstones = tombstones
+        namespace = base.get("__builtins__", builtins)
+        self.builtins = getattr(namespace, "__dict__", namespace)
+        dict.update(self, ((key, value)
+                           for key, value in self.builtins.items()
+                           if key not in base or key in tombstones))
+
+    def __missing__(self, key):
+        if key in self.base and key not in self.tombstones:
+            return self.base[key]
+        return self.builtins[key]
+
+def layered_find(find):
+    """
+    Wraps the ``doctest.DocTestFinder.find`` method so the doctests found
+    in a module get ``LayeredGlobals`` sharing a single copy of the module
+    namespace instead of a full copy of it for each docstring. Doctests
+    with a ``global`` statement get a plain copy instead, as the
+    interpreter stores and deletes these names bypassing the layers.
+    """
+    @functools.wraps(find)
+    def wrapper(finder, obj, name=None, module=None, globs=None,
+                extraglobs=None):
+        import inspect
+        if globs is None and module is None and inspect.ismodule(obj):
+            globs = LayeredGlobals(obj.__dict__.copy())
+        tests = find(finder, obj, name, module, globs, extraglobs)
+        for test in tests:
+            if isinstance(test.globs, LayeredGlobals) and has_global(test):
+                plain = test.globs.merged()
+                plain["__builtins__"] = test.globs.base.get("__builtins__",
+                                                            builtins)
+                test.globs = plain
+        return tests
+    return wrapper
+
+def has_global(test):
+    """Tells whether some doctest example has a ``global`` statement."""
+    import ast
+    for example in test.examples:
+        if "global" in example.source:
+            try:
+                tree = ast.parse(example.source)
+            except SyntaxError:
+                continue
+            if any(isinstance(node, ast.Global) for node in ast.walk(tree)):
+                return True
+    return False
+
+class LayeredCollector(object):
+    """
+    Plugin that makes the doctest modules be collected with
+    ``LayeredGlobals`` for their docstrings.
+    """
+    @hookwrapper
+    def pytest_make_collect_report(self, collector):
+        from _pytest.doctest import DoctestModule
+        if isinstance(collector, DoctestModule):
+            import doctest
+            find = doctest.DocTestFinder.find
+            doctest.DocTestFinder.find = layered_find(find)
+            try:
+                yield
+            finally:
+                doctest.DocTestFinder.find = find
+        else:
+            yield
+
+class DoctestIncremental(object):
+    """
+    Plugin that skips the doctests that passed before, unless their
+    docstring, module source, formatter address, option flags or
+    the Python version had changed since then. Passing doctest keys are
+    stored in the py.test cache directory.
+    """
+    cache_name = "doctest_custom/incremental"
+
+    def __init__(self, config):
+        self.config = config
+        self.passed = config.cache.get(self.cache_name, {})
+        self.source_hashes = {}
+        self.keys = {} # Keys of the doctests that ran in this session
+        self.updates = {}
+        self.cached = 0
+
+    def source_hash(self, path):
+        if path not in self.source_hashes:
+            with open(str(path), "rb") as f:
+                self.source_hashes[path] = hashlib.sha1(f.read()).hexdigest()
+        return self.source_hashes[path]
+
+    def key(self, item):
+        dtest = getattr(item, "dtest", None) # Not on py.test < 2.4
+        runner = getattr(item, "runner", None)
+        parts = [
+          getattr(dtest, "docstring", None) or "",
+          self.source_hash(item.fspath),
+          " ".join([item_repr_address(item) or ""] +
+                   repr_type_entries(self.config)),
+          str(getattr(runner, "optionflags", "")),
+          " ".join(self.config.getini("doctest_optionflags")),
+          sys.version,
+          __version__,
+        ]
+        return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+    @tryfirst
+    def pytest_runtest_setup(self, item):
+        if is_doctest(item):
+            key = self.keys[item.nodeid] = self.key(item)
+            if self.passed.get(item.nodeid) == key:
+                self.cached += 1
+                pytest.skip("cached (passed before, unchanged)")
+
+    def pytest_runtest_logreport(self, report):
+        if report.nodeid in self.keys:
+            if report.failed:
+                self.updates[report.nodeid] = None
+            elif report.passed and report.when == "call":
+                self.updates[report.nodeid] = self.keys[report.nodeid]
+
+    def pytest_sessionfinish(self, session):
+        if self.updates: # Re-read, as pytest-xdist workers share the cache
+            passed = self.config.cache.get(self.cache_name, {})
+            for nodeid, key in self.updates.items():
+                if key is None:
+                    passed.pop(nodeid, None)
+                else:
+                    passed[nodeid] = key
+            self.config.cache.set(self.cache_name, passed)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        terminalreporter.write_sep("-", "doctest incremental")
+        terminalreporter.write_line("{0} unchanged doctests skipped as cached"
+                                    .format(self.cached))
+
+class DoctestFork(object):
+    """
+    Plugin that runs the doctests of each file in a forked child process,
+    so the global state changes they make don't leak to other files. The
+    main py.test process is the warm parent (zygote) that had imported the
+    doctest modules, the formatter and the preload modules before forking
+    the copy-on-write children, which stream back their serialized reports
+    through a pipe as soon as each doctest finishes.
+    """
+    def __init__(self, config, preload):
+        self.config = config
+        self.preload = preload
+        self.preload_time = 0.
+        self.children = self.crashed = 0
+        self.started = False # Unless interrupted or in --collect-only
+
+    def run_child(self, items, nextitem, write_fd):
+        """
+        Runs the items in the child process, sending their reports, until
+        the ``--maxfail`` limit is reached (also counting the failures the
+        parent process had already logged).
+        """
+        import json, traceback
+        from _pytest.runner import runtestprotocol
+        hook = self.config.hook
+        maxfail = self.config.getoption("maxfail")
+        failed = items[0].session.testsfailed
+        status = 0
+        try:
+            with os.fdopen(write_fd, "w") as pipe:
+                for idx, item in enumerate(items):
+                    next_item = items[idx + 1] if idx + 1 < len(items) \
+                                               else nextitem
+                    reports = runtestprotocol(item, log=False,
+                                              nextitem=next_item)
+                    data = [hook.pytest_report_to_serializable(
+                              config=self.config, report=report)
+                            for report in reports]
+                    pipe.write(json.dumps([idx, data]) + "\n")
+                    pipe.flush()
+                    failed += sum(report.failed and
+                                  not hasattr(report, "wasxfail")
+                                  for report in reports)
+                    if maxfail and failed >= maxfail:
+                        break
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def run_group(self, items, nextitem):
+        """Forks a child to run the items, logging their reports."""
+        import json
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(read_fd)
+            self.run_child(items, nextitem, write_fd) # Never returns
+        os.close(write_fd)
+        self.children += 1
+        hook = self.config.hook
+        done = set()
+        with os.fdopen(read_fd) as pipe:
+            for line in pipe:
+                idx, data = json.loads(line)
+                log_reports(items[idx], [
+                  hook.pytest_report_from_serializable(config=self.config,
+                                                       data=report_data)
+                  for report_data in data
+                ])
+                done.add(idx)
+        status = os.waitpid(pid, 0)[1]
+        session = items[0].session
+        if getattr(session, "shouldfail", False) or session.shouldstop:
+            return # The child stopped on --maxfail
+        from _pytest.runner import TestReport
+        for idx, item in enumerate(items):
+            if idx not in done:
+                self.crashed += 1
+                longrepr = "doctest fork child process crashed (wait " \
+                           "status {0})".format(status)
+                log_reports(item, [TestReport(item.nodeid, item.location,
+                                              dict.fromkeys(item.keywords, 1),
+                                              "failed", longrepr, "call")])
+
+    def pytest_runtestloop(self, session):
+        """
+        Imports the preload modules, then runs the doctest items of each
+        file in a child process, and the other items in this process. The
+        ``nextitem`` of these is the next item that runs in this process,
+        so its setup state is torn down regardless of the forked ones.
+        """
+        option = session.config.option
+        if session.testsfailed and \
+           not getattr(option, "continue_on_collection_errors", False):
+            raise session.Interrupted("{0} error{1} during collection".format(
+              session.testsfailed, "" if session.testsfailed == 1 else "s"))
+        if option.collectonly:
+            return
+        self.started = True
+        start = clock_ns()
+        for module_name in self.preload:
+            try:
+                import_module(module_name)
+            except ImportError as exc:
+                raise PluginError(exc)
+        self.preload_time = (clock_ns() - start) * 1e-9
+        items = session.items
+        local_next = [None] * len(items)
+        for idx in range(len(items) - 2, -1, -1):
+            following = items[idx + 1]
+            local_next[idx] = local_next[idx + 1] if is_doctest(following) \
+                              else following
+        idx = 0
+        while idx < len(items):
+            item = items[idx]
+            end = idx + 1
+            if is_doctest(item):
+                while end < len(items) and is_doctest(items[end]) and \
+                      items[end].parent is item.parent:
+                    end += 1
+            nextitem = items[end] if end < len(items) else None
+            if is_doctest(item):
+                self.run_group(items[idx:end], nextitem)
+            else:
+                item.config.hook.pytest_runtest_protocol(
+                  item=item, nextitem=local_next[idx])
+            if getattr(session, "shouldfail", False):
+                raise session.Failed(session.shouldfail)
+            if session.shouldstop:
+                raise session.Interrupted(session.shouldstop)
+            idx = end
+        return True
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.started:
+            return
+        terminalreporter.write_sep("-", "doctest fork")
+        terminalreporter.write_line(
+            "{0} forked children ({1} crashed doctests), {2:.6f}s preloading "
+            "{3} modules".format(self.children, self.crashed,
+                                 self.preload_time, len(self.preload)))
+
+def log_reports(item, reports):
+    """Logs the reports of an item that ran in another process."""
+    item.ihook.pytest_runtest_logstart(nodeid=item.nodeid,
+                                       location=item.location)
+    for report in reports:
+        item.ihook.pytest_runtest_logreport(report=report)
+    item.ihook.pytest_runtest_logfinish(nodeid=item.nodeid,
+                                        location=item.location)
+
 HELP = {
   "plugin": "custom display hook for doctests",
   "repr": "MODULE:CALLABLE address to a representation formatter or printer "
           "(e.g. IPython.lib.pretty:pretty, pprint:pformat, ascii, repr)",
+  "repr_cache": "cache up to MAXSIZE representations of immutable values and "
+                "built-in containers, reusing them when the same value is "
+                "displayed again",
+  "repr_cache_bytes": "size limit in bytes for the representation cache "
+                      "(default: %(default)s)",
+  "workers": "run the tests in N worker processes, sharded by source file "
+             "(requires pytest-xdist)",
+  "repr_type": "TYPE=FORMATTER pair of MODULE:OBJECT addresses to use a "
+               "specific representation formatter or printer for values of "
+               "that type (can be used more than once)",
+  "repr_ini": "MODULE:CALLABLE address like --doctest-repr, used when "
+              "that option isn't given",
+  "repr_types": "TYPE=FORMATTER lines, like --doctest-repr-type",
+  "durations": "show the N doctests that spent the most time in the "
+               "formatter (N=0 for all), with their total time",
+  "context_local": "hold the formatter and the doctest output stream per "
+                   "thread/context instead of replacing them process-wide, "
+                   "so doctests can run concurrently in threads",
+  "async": "allow top-level await in doctest examples, running them on an "
+           "asyncio event loop shared by each docstring or module (SCOPE)",
+  "max_bytes": "make the doctest example fail as soon as its displayed "
+               "representation exceeds MAXBYTES bytes (UTF-8 encoded)",
+  "max_lines": "make the doctest example fail as soon as its displayed "
+               "representation exceeds MAXLINES lines",
+  "repr_timeout": "make the doctest example fail when displaying its value "
+                  "takes more than SECONDS, stopping the formatter",
+  "compare_literals": "compare the displayed values with the expected "
+                      "outputs that are Python literals, calling the "
+                      "formatter only when they differ",
+  "diff_threshold": "for doctest outputs with more than N lines, elide the "
+                    "common lines and keep at most N differing lines in the "
+                    "failure report, so its diff is fast",
+  "buffered": "batch the writes of each displayed representation in a "
+              "single one (e.g. for printers writing small chunks)",
+  "example_cache": "store the parsed doctest examples and their compiled "
+                   "code in the py.test cache, reusing them for unchanged "
+                   "docstrings",
+  "example_cache_clear": "clear the --doctest-example-cache contents "
+                         "before running",
+  "static_scan": "don't import the modules that can't have doctests, "
+                 "according to a static scan of their source code",
+  "layered_globals": "give each docstring a small namespace layered on a "
+                     "single shared copy of the module namespace, instead "
+                     "of a full copy of it",
+  "fork": "run the doctests of each file in a process forked from the "
+          "main one after importing the formatter and the preload modules, "
+          "isolating their global state changes (requires os.fork)",
+  "fork_preload": "module to be imported once before forking, with "
+                  "--doctest-fork (can be used more than once)",
+  "memory": "trace the memory allocated by each doctest, showing the N "
+            "doctests with the highest peak (N=0 for all) and the memory "
+            "they retained (requires tracemalloc)",
+  "clear_globals": "clear the doctest globals right after each doctest "
+                   "item, even when it didn't run (e.g. skipped)",
+  "profile": "profile the doctest items whose node ID matches the GLOB "
+             "pattern with cProfile, writing pstats files and a summary of "
+             "their time in the example code, formatter and doctest",
+  "profile_dir": "directory for the --doctest-profile pstats files "
+                 "(default: %(default)s)",
+  "incremental": "skip the doctests that passed in a previous run and whose "
+                 "docstring, module source and settings didn't change",
 }
 
+class Hookspecs(object):
+    """Hook specifications added by this plugin."""
+
+    @firstresult
+    def pytest_doctest_repr(self, item):
+        """
+        Formatter address for the doctest item, or None to keep the
+        ``--doctest-repr`` one. Implemented in a ``conftest.py`` file, it
+        applies only to the doctests in that directory and below it.
+        """
+
+def pytest_addhooks(pluginmanager):
+    """Hook that adds the plugin hook specifications."""
+    add_hookspecs = getattr(pluginmanager, "add_hookspecs", None) or \
+                    pluginmanager.addhooks # py.test < 2.8
+    add_hookspecs(Hookspecs)
+
 def pytest_addoption(parser):
-    """Hook that adds the plugin option for customizing the plugin."""
+    """Hook that adds the plugin options for customizing the plugin."""
     group = parser.getgroup("doctest_custom", HELP["plugin"])
     group.addoption("--doctest-repr", default=None, help=HELP["repr"])
+    group.addoption("--doctest-repr-type", default=[], action="append",
+                    metavar="TYPE=FORMATTER", help=HELP["repr_type"])
+    group.addoption("--doctest-repr-cache", default=None, type=int,
+                    metavar="MAXSIZE", help=HELP["repr_cache"])
+    group.addoption("--doctest-repr-cache-bytes", default=2 ** 24, type=int,
+                    metavar="MAXBYTES", help=HELP["repr_cache_bytes"])
+    group.addoption("--doctest-repr-durations", default=None, type=int,
+                    metavar="N", help=HELP["durations"])
+    group.addoption("--doctest-repr-max-bytes", default=None, type=int,
+                    metavar="MAXBYTES", help=HELP["max_bytes"])
+    group.addoption("--doctest-repr-max-lines", default=None, type=int,
+                    metavar="MAXLINES", help=HELP["max_lines"])
+    group.addoption("--doctest-repr-timeout", default=None, type=float,
+                    metavar="SECONDS", help=HELP["repr_timeout"])
+    group.addoption("--doctest-compare-literals", action="store_true",
+                    help=HELP["compare_literals"])
+    group.addoption("--doctest-diff-threshold", default=None, type=int,
+                    metavar="N", help=HELP["diff_threshold"])
+    group.addoption("--doctest-repr-buffered", action="store_true",
+                    help=HELP["buffered"])
+    group.addoption("--doctest-workers", default=None, type=int,
+                    metavar="N", help=HELP["workers"])
+    group.addoption("--doctest-context-local", action="store_true",
+                    help=HELP["context_local"])
+    group.addoption("--doctest-async", default=None, metavar="SCOPE",
+                    choices=["docstring", "module"], help=HELP["async"])
+    group.addoption("--doctest-example-cache", action="store_true",
+                    help=HELP["example_cache"])
+    group.addoption("--doctest-example-cache-clear", action="store_true",
+                    help=HELP["example_cache_clear"])
+    group.addoption("--doctest-static-scan", action="store_true",
+                    help=HELP["static_scan"])
+    group.addoption("--doctest-layered-globals", action="store_true",
+                    help=HELP["layered_globals"])
+    group.addoption("--doctest-fork", action="store_true", help=HELP["fork"])
+    group.addoption("--doctest-fork-preload", default=[], action="append",
+                    metavar="MODULE", help=HELP["fork_preload"])
+    group.addoption("--doctest-memory", default=None, type=int,
+                    metavar="N", help=HELP["memory"])
+    group.addoption("--doctest-clear-globals", action="store_true",
+                    help=HELP["clear_globals"])
+    group.addoption("--doctest-profile", default=None, metavar="GLOB",
+                    help=HELP["profile"])
+    group.addoption("--doctest-profile-dir", default="doctest_profile",
+                    metavar="DIR", help=HELP["profile_dir"])
+    group.addoption("--doctest-incremental", action="store_true",
+                    help=HELP["incremental"])
+    parser.addini("doctest_repr", HELP["repr_ini"])
+    parser.addini("doctest_repr_types", HELP["repr_types"], type="linelist")
+
+@hookwrapper
+def pytest_cmdline_main(config):
+    """
+    Hook wrapper that translates ``--doctest-workers`` to the pytest-xdist
+    ``--numprocesses`` and ``--dist=loadfile`` options before xdist sees
+    them, so each source file is imported by a single worker. Each worker
+    is a new py.test process that resolves the ``--doctest-repr`` address
+    on its own, the formatter object itself is never sent to the workers.
+    Not available before py.test 2.7, where it would be a plain hook.
+    """
+    workers = config.option.doctest_workers
+    if workers and not (hasattr(config, "workerinput") or
+                        hasattr(config, "slaveinput")): # pytest-xdist < 1.22
+        if not config.pluginmanager.hasplugin("xdist"):
+            raise PluginError(ImportError("--doctest-workers requires the "
+                                          "pytest-xdist plugin"))
+        if not getattr(config.option, "numprocesses", None):
+            config.option.numprocesses = workers
+        if getattr(config.option, "dist", "no") == "no":
+            config.option.dist = "loadfile"
+    yield
+
+if not has_hookwrappers:
+    del pytest_cmdline_main
+
+HOOKWRAPPER_OPTIONS = ["doctest_workers", "doctest_repr_durations",
+                       "doctest_memory", "doctest_profile",
+                       "doctest_static_scan", "doctest_layered_globals",
+                       "doctest_clear_globals"]
 
 def pytest_configure(config):
+    """Config time hook that registers the optional plugin components."""
+    if not has_hookwrappers:
+        for name in HOOKWRAPPER_OPTIONS:
+            value = getattr(config.option, name)
+            if value is not None and value is not False:
+                raise PluginError(ValueError("--{0} requires py.test 2.7+"
+                                             .format(name.replace("_", "-"))))
+    printer.timer = printer.limits = None
+    printer.show = display_buffered if config.option.doctest_repr_buffered \
+                   else display
+    limits = (config.option.doctest_repr_max_bytes,
+              config.option.doctest_repr_max_lines)
+    if limits != (None, None):
+        printer.limits = limits
+        if printer.show is display:
+            printer.show = display_limited
+    if config.option.doctest_repr_timeout:
+        printer.show = ReprTimeout(printer.show,
+                                   config.option.doctest_repr_timeout)
+    if config.option.doctest_compare_literals:
+        printer.show = LiteralComparison(printer.show)
+    if config.option.doctest_repr_durations is not None:
+        printer.timer = ReprDurations(config.option.doctest_repr_durations)
+        config.pluginmanager.register(printer.timer, "doctest_repr_durations")
+    config._doctest_async = None
+    if config.option.doctest_async:
+        if sys.version_info < (3, 8):
+            raise PluginError(ValueError("--doctest-async requires "
+                                         "Python 3.8+"))
+        config._doctest_async = AsyncLoops(config.option.doctest_async)
+        config.pluginmanager.register(config._doctest_async,
+                                      "doctest_async")
+    config._doctest_memory = None
+    if config.option.doctest_memory is not None:
+        try:
+            import tracemalloc
+        except ImportError:
+            raise PluginError(ValueError("--doctest-memory requires "
+                                         "tracemalloc (Python 3.4+)"))
+        config._doctest_memory = DoctestMemory(config.option.doctest_memory)
+        config.pluginmanager.register(config._doctest_memory,
+                                      "doctest_memory")
+    config._doctest_profile = None
+    if config.option.doctest_profile is not None:
+        config._doctest_profile = DoctestProfile(
+                                    config.option.doctest_profile,
+                                    config.option.doctest_profile_dir)
+        config.pluginmanager.register(config._doctest_profile,
+                                      "doctest_profile")
+    config._doctest_examples = None
+    if config.option.doctest_example_cache:
+        if not hasattr(config, "cache"):
+            raise PluginError(ValueError("--doctest-example-cache requires "
+                                         "the py.test cache (py.test 2.8+)"))
+        config._doctest_examples = ExampleCache(config,
+            clear=config.option.doctest_example_cache_clear)
+        config.pluginmanager.register(config._doctest_examples,
+                                      "doctest_example_cache")
+    if config.option.doctest_static_scan:
+        config.pluginmanager.register(StaticIndex(config),
+                                      "doctest_static_scan")
+    if config.option.doctest_layered_globals:
+        if sys.version_info < (3, 3):
+            raise PluginError(ValueError("--doctest-layered-globals requires "
+                                         "Python 3.3+"))
+        config.pluginmanager.register(LayeredCollector(),
+                                      "doctest_layered_globals")
+    if config.option.doctest_clear_globals:
+        config.pluginmanager.register(GlobalsCleaner(),
+                                      "doctest_clear_globals")
+    if config.option.doctest_fork:
+        if not hasattr(os, "fork"):
+            raise PluginError(ValueError("--doctest-fork requires os.fork"))
+        if not hasattr(config.hook, "pytest_report_to_serializable"):
+            raise PluginError(ValueError("--doctest-fork requires "
+                                         "py.test 4.4+"))
+        config.pluginmanager.register(DoctestFork(config,
+            config.option.doctest_fork_preload), "doctest_fork")
+    if config.option.doctest_incremental:
+        if not hasattr(config, "cache"):
+            raise PluginError(ValueError("--doctest-incremental requires the "
+                                         "py.test cache (py.test 2.8+)"))
+        config.pluginmanager.register(DoctestIncremental(config),
+                                      "doctest_incremental")
+
+def repr_type_entries(config):
+    """The ``TYPE=FORMATTER`` entries from both the ini file and options."""
+    cli_entries = config.option.doctest_repr_type
+    return config.getini("doctest_repr_types") + cli_entries
+
+def default_repr_address(config):
+    """The ``--doctest-repr`` address, or the ini one, or None."""
+    if config.option.doctest_repr is None:
+        return config.getini("doctest_repr") or None
+    return config.option.doctest_repr
+
+def item_repr_address(item):
+    """
+    The formatter address for the doctest item, from the nearest
+    ``pytest_doctest_repr`` hook (i.e., its ``conftest.py`` files) or the
+    ``default_repr_address``.
     """
-    Config time (before session starts) hook that:
+    address = item.ihook.pytest_doctest_repr(item=item)
+    return default_repr_address(item.config) if address is None else address
+
+def has_repr_hook(config):
+    """Tells whether some plugin or conftest implements the repr hook."""
+    hook = config.hook.pytest_doctest_repr
+    try:
+        return bool(hook.get_hookimpls())
+    except AttributeError: # Old pluggy, assume it's implemented
+        return True
 
-    1. Parses/validates the plugin options;
+def is_doctest(item):
+    """Tells whether the given collected item is a doctest."""
+    from _pytest.doctest import DoctestItem
+    return isinstance(item, DoctestItem)
 
-    2. Changes ``doctest.DocTestRunner.run`` method so that the
-    ``sys.__displayhook__`` and ``sys.displayhook`` are the plugin printer
-    function while a doctest is running, restoring them back afterwards.
+def pytest_collectstart(collector):
     """
-    doctest_repr = config.option.doctest_repr
-    if doctest_repr is not None:
-        import doctest
-        printer.repr = parse_address(doctest_repr)
-        enable_printer = temp_replace(sys, "__displayhook__", printer)
-        doctest.DocTestRunner.run = enable_printer(doctest.DocTestRunner.run)
-    # As the public method doctest.DocTestRunner.run replaces sys.displayhook
-    # by sys.__displayhook__, that's enough. We could also had changed the
-    # displayhook on the _DocTestRunner__run protected method leaving the
-    # __displayhook__ as it is, for the sake of customizing doctests outputs
+    Collection hook that enables the plugin printer before importing the
+    ``--doctest-repr`` formatter module as a doctest module, as it might
+    assign the standard streams to its objects at import time.
+    """
+    from _pytest.doctest import DoctestModule
+    address = default_repr_address(collector.config)
+    if address and ":" in address and isinstance(collector, DoctestModule):
+        module_name = address.split(":", 1)[0]
+        if collector.fspath.purebasename == module_name.split(".")[-1]:
+            enable_printer(collector.config)
+
+@tryfirst
+def pytest_runtestloop(session):
+    """
+    Run time hook that enables the plugin printer only when there's some
+    doctest to run, installing it on the doctest items, so the
+    ``--doctest-repr`` formatter module (and the ``doctest`` module itself)
+    isn't imported on runs without doctests, like unit tests selected with
+    ``-k`` or a ``--collect-only`` call.
+    """
+    config = session.config
+    enabled = default_repr_address(config) is not None or \
+              has_repr_hook(config) or \
+              config.option.doctest_async or \
+              config.option.doctest_repr_timeout or \
+              config.option.doctest_repr_max_bytes is not None or \
+              config.option.doctest_repr_max_lines is not None or \
+              config.option.doctest_repr_durations is not None or \
+              config.option.doctest_repr_cache or \
+              config.option.doctest_repr_buffered or \
+              config.option.doctest_diff_threshold is not None or \
+              config.option.doctest_compare_literals or \
+              config.option.doctest_memory is not None or \
+              config.option.doctest_profile is not None or \
+              config.option.doctest_example_cache or repr_type_entries(config)
+    if enabled and not config.option.collectonly:
+        items = [item for item in session.items if is_doctest(item)]
+        if items:
+            enable_printer(config)
+            for item in items:
+                install_printer(item)
+
+def enable_printer(config):
+    """
+    Plugin startup that:
+
+    1. Resolves the type-specific formatter addresses;
+
+    2. Registers the representation cache, when required;
+
+    3. Resolves the ``--doctest-repr`` address (defaults to ``repr``) as
+    the default formatter.
+
+    Nothing is done when the plugin printer was already enabled.
+    """
+    if getattr(config, "_doctest_repr_enabled", False):
+        return
+    config._doctest_repr_enabled = True
+    config._doctest_formatters = {}
+    entries = repr_type_entries(config)
+    config._doctest_types = OrderedDict(map(parse_type_entry, entries))
+    config._doctest_repr_cache = None
+    address = default_repr_address(config)
+    formatter = resolve_formatter(config, address)
+    if config.option.doctest_repr_cache:
+        formatter = config._doctest_repr_cache = ReprCache(formatter,
+            config.option.doctest_repr_cache,
+            config.option.doctest_repr_cache_bytes)
+        config.pluginmanager.register(formatter, "doctest_repr_cache")
+        config._doctest_formatters[address] = formatter
+    printer.repr = config._doctest_repr = formatter
+
+def resolve_formatter(config, address):
+    """
+    Formatter for the given address (None for ``repr``), dispatching by
+    type and using the representation cache when required. Each address
+    is resolved only once in the session.
+    """
+    try:
+        return config._doctest_formatters[address]
+    except KeyError:
+        pass
+    formatter = parse_address("repr" if address is None else address)
+    if config._doctest_types:
+        formatter = TypeDispatcher(formatter, config._doctest_types)
+    if config._doctest_repr_cache is not None:
+        formatter = functools.partial(config._doctest_repr_cache.cached,
+                                      formatter)
+    config._doctest_formatters[address] = formatter
+    return formatter
+
+def install_printer(item):
+    """
+    Makes the doctest item use the plugin printer as its display hook, by
+    changing the class of its runner to a ``runner_class`` one. Items
+    without a runner (py.test < 2.4) get the ``sys.__displayhook__``
+    replaced while running, as ``doctest.DocTestRunner.run`` replaces
+    ``sys.displayhook`` by it, and they always use the default formatter.
+    """
+    runner = getattr(item, "runner", None)
+    context_local = item.config.option.doctest_context_local
+    if runner is None:
+        replace_displayhook = temp_replace(sys, "__displayhook__", printer)
+        item.runtest = replace_displayhook(item.runtest)
+        return
+    if not getattr(runner, "_doctest_custom", False):
+        runner.__class__ = runner_class(type(runner), context_local)
+    runner._doctest_repr = item.config._doctest_repr
+    formatter = resolve_formatter(item.config, item_repr_address(item))
+    if formatter is not runner._doctest_repr: # Shared by the module items
+        replace_formatter = temp_replace(runner, "_doctest_repr", formatter)
+        item.runtest = replace_formatter(item.runtest)
+    runner._doctest_async = item.config._doctest_async
+    wrappers = item.config._doctest_memory, item.config._doctest_profile
+    runner._doctest_wrappers = tuple(filter(None, wrappers))
+    runner._doctest_diff_threshold = item.config.option.doctest_diff_threshold
+    examples = item.config._doctest_examples
+    if examples is not None:
+        runner._doctest_replace = examples.compile_replace()
+
+context_replace = SharedReplace(
+  (sys, "stdout", stdout_proxy),
+  (sys, "displayhook", printer),
+  (sys, "__displayhook__", printer),
+  (printer, "repr", context_formatter),
+)
+
+def runner_class(base, context_local=False, cache={}):
+    """
+    Subclass of the given ``doctest.DocTestRunner`` class that uses the
+    plugin printer as the display hook for the examples, created once for
+    each base class. Unlike monkeypatching ``doctest.DocTestRunner.run``,
+    that doesn't change other doctest runners in the same process. The
+    printer uses the runner formatter (the ``_doctest_repr`` attribute)
+    while running, when it's not None.
+
+    In the context local mode, the runner output stream and its formatter
+    are bound to the current context or
+    thread while running, and the ``sys`` stream and display hooks are
+    shared by the concurrent runs, allowing them to run in threads.
+    """
+    key = base, context_local
+    if key not in cache:
+        def _DocTestRunner__run(self, test, compileflags, out):
+            backup = sys.displayhook, printer.repr
+            sys.displayhook = printer
+            if self._doctest_repr is not None and not context_local:
+                printer.repr = self._doctest_repr
+            try:
+                with self._doctest_replace:
+                    if self._doctest_async is None:
+                        return base._DocTestRunner__run(self, test,
+                                                        compileflags, out)
+                    return self._doctest_async.run(self,
+                                                   base._DocTestRunner__run,
+                                                   test, compileflags, out)
+            finally:
+                sys.displayhook, printer.repr = backup
+        def report_failure(self, out, test, example, got):
+            if self._doctest_diff_threshold is not None:
+                example, got = bounded_diff_example(
+                                 example, got, self._doctest_diff_threshold)
+            return base.report_failure(self, out, test, example, got)
+        def run(self, *args, **kwargs):
+            func = base.run
+            for wrapper in self._doctest_wrappers:
+                func = functools.partial(wrapper.run, func)
+            return func(self, *args, **kwargs)
+        namespace = {
+          "_DocTestRunner__run": _DocTestRunner__run,
+          "report_failure": report_failure,
+          "run": run,
+          "_doctest_custom": True,
+          "_doctest_repr": None,
+          "_doctest_async": None,
+          "_doctest_wrappers": (),
+          "_doctest_diff_threshold": None,
+          "_doctest_replace": SharedReplace(),
+        }
+        if context_local:
+            def context_run(self, *args, **kwargs):
+                fakeout, self._fakeout = self._fakeout, stdout_proxy
+                stream_token = stdout_proxy.bind(fakeout)
+                repr_token = context_formatter.bind(self._doctest_repr)
+                try:
+                    with context_replace:
+                        return run(self, *args, **kwargs)
+                finally:
+                    context_formatter.unbind(repr_token)
+                    stdout_proxy.unbind(stream_token)
+                    self._fakeout = fakeout
+            namespace["run"] = context_run
+            namespace["save_linecache_getlines"] = property(
+              lambda self: self._save_linecache_getlines,
+              lambda self, getlines: setattr(self, "_save_linecache_getlines",
+                                             unpatched_getlines(getlines)),
+            )
+        cache[key] = type(base.__name__, (base,), namespace)
+    return cache[key]
+
+def bounded_diff_example(example, got, threshold, context=3):
+    """
+    Gets an ``(example, got)`` pair whose expected/got outputs are trimmed
+    for the failure report, when any of them has more than ``threshold``
+    lines. The common leading and trailing lines are elided (but for
+    ``context`` lines), and at most ``threshold`` lines of the remaining
+    differing window are kept, so the report diff is fast even for huge
+    outputs. The original example object is kept unchanged.
+    """
+    import doctest
+    want_lines = example.want.splitlines(True)
+    got_lines = got.splitlines(True)
+    if max(len(want_lines), len(got_lines)) <= threshold:
+        return example, got
+    size = min(len(want_lines), len(got_lines))
+    start = end = 0
+    while start < size and want_lines[start] == got_lines[start]:
+        start += 1
+    while end < size - start and want_lines[-1 - end] == got_lines[-1 - end]:
+        end += 1
+    head = max(start - context, 0)
+    tail = max(end - context, 0)
+
+    def window(lines):
+        lines = [line if line.endswith("\n") else line + "\n"
+                 for line in lines]
+        middle = lines[start:len(lines) - end]
+        result = []
+        if head:
+            result.append("<doctest-diff: {0} equal lines elided>\n"
+                          .format(head))
+        result.extend(lines[head:start])
+        result.extend(middle[:threshold])
+        if len(middle) > threshold:
+            result.append("<doctest-diff: {0} more lines elided>\n"
+                          .format(len(middle) - threshold))
+        result.extend(lines[len(lines) - end:len(lines) - tail])
+        if tail:
+            result.append("<doctest-diff: {0} equal lines elided>\n"
+                          .format(tail))
+        return "".join(result)
+
+    bounded = doctest.Example(example.source, window(want_lines),
+                              example.exc_msg, example.lineno, example.indent,
+                              example.options)
+    return bounded, window(got_lines)
+
+def unpatched_getlines(getlines):
+    """
+    Gets the ``linecache.getlines`` function replaced by doctest runners
+    that are still running (or not), as concurrent runners restoring it
+    in a different order would otherwise create a recursive cycle.
+    """
+    import doctest
+    patched = doctest.DocTestRunner._DocTestRunner__patched_linecache_getlines
+    patched = getattr(patched, "__func__", patched)
+    while getattr(getlines, "__func__", None) is patched:
+        getlines = getlines.__self__.save_linecache_getlines
+    return getlines
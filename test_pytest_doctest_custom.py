@@ -7,6 +7,15 @@ PYPY = platform.python_implementation() == "PyPy"
 JYTHON = platform.python_implementation() == "Jython"
 PY2 = sys.version_info[0] == 2
 SPLIT_DOCTEST = pytest.__version__ >= "2.4"
+try:
+    from StringIO import StringIO # Python 2, for str values
+except ImportError:
+    from io import StringIO
+try:
+    import xdist
+    XDIST = True
+except ImportError:
+    XDIST = False
 
 # Avoid py._path.local.LocalPath.pyimport from raising
 # ImportMismatchError when --runpytest=subprocess
@@ -369,6 +378,37 @@ class TestPPrintPPrintAsRepr(ATestPPrint):
     src_mymodule = TestPPrintPFormatAsRepr.src_mymodule
 
 
+class TestPPrintPPrintBufferedAsRepr(TestPPrintPPrintAsRepr):
+    args, args_conftest, args_mymodule = [
+      args + ("--doctest-repr-buffered",)
+      for args in [TestPPrintPPrintAsRepr.args,
+                   TestPPrintPPrintAsRepr.args_conftest,
+                   TestPPrintPPrintAsRepr.args_mymodule]
+    ]
+
+    def test_proxy_write(self, monkeypatch):
+        proxy = pytest_doctest_custom.StandardStreamProxy("stdout")
+        first, second = StringIO(), StringIO()
+        monkeypatch.setattr(sys, "stdout", first)
+        proxy.write("a")
+        monkeypatch.setattr(sys, "stdout", second)
+        proxy.write("b")
+        token = proxy.bind(first)
+        proxy.write("c")
+        proxy.unbind(token)
+        proxy.write("d")
+        assert (first.getvalue(), second.getvalue()) == ("ac", "bd")
+
+    def test_buffered_stream(self):
+        stream = StringIO()
+        buffered = pytest_doctest_custom.BufferedStream(stream)
+        buffered.write("a")
+        buffered.write("b")
+        assert stream.getvalue() == ""
+        buffered.flush_buffer()
+        assert stream.getvalue() == "ab"
+
+
 @pytest.mark.skipif(JYTHON, reason="IPython doesn't run on Jython")
 class ATestIPython(ATestList, ATestDict, ATestSet):
     set3repr = "{3}"
@@ -415,11 +455,121 @@ class TestIPythonPPrintAsRepr(ATestIPython):
     '''
 
 
+class TestPrettyAsRepr(ATestList, ATestDict, ATestSet):
+    set3repr = "{3}"
+
+    args = ("--doctest-repr=pytest_doctest_custom:pretty",
+            "--verbose", "--doctest-modules")
+
+    args_conftest = ("--doctest-repr", "conftest:doctest_pretty",
+                     "--verbose", "--doctest-modules")
+
+    args_mymodule = ("--doctest-repr", "mymodule:doctest_pretty",
+                     "--verbose", "--doctest-modules")
+
+    src_conftest = src_mymodule = '''
+        from pytest_doctest_custom import pretty
+        def doctest_pretty(value):
+            return pretty(value, max_width=150)
+    '''
+
+    if JYTHON and not SPLIT_DOCTEST:
+       src_mymodule += JYTHON_FIX
+
+    @pytest.mark.parametrize(("value", "expected"), [
+      ((1,), "(1,)"),
+      ((), "()"),
+      (set(), "set()"),
+      (frozenset([3, 1, 2]), "frozenset({1, 2, 3})"),
+      ({2: (), 1: [None]}, "{1: [None], 2: ()}"),
+      (set([None, "x", 1]), "{None, 1, 'x'}"),
+      (type("Sub", (list,), {})([2, 1]), "[2, 1]"),
+      (type("Sub", (dict,), {"__repr__": lambda self: "Sub"})(), "Sub"),
+    ])
+    def test_single_line(self, value, expected):
+        assert pytest_doctest_custom.pretty(value) == expected
+
+    def test_line_breaks(self):
+        value = [{"a" * 20: list(range(12)), "b": (1,)}, "c" * 30]
+        result = pytest_doctest_custom.pretty(value, max_width=50)
+        assert result == "\n".join([
+          "[{'aaaaaaaaaaaaaaaaaaaa': [0,",
+          "                           1,",
+          "                           2,",
+          "                           3,",
+          "                           4,",
+          "                           5,",
+          "                           6,",
+          "                           7,",
+          "                           8,",
+          "                           9,",
+          "                           10,",
+          "                           11],",
+          "  'b': (1,)},",
+          " 'cccccccccccccccccccccccccccccc']",
+        ])
+
+    def test_nested_in_dict(self):
+        value = {"k": set(range(4)), "a": [(1, 2)]}
+        result = pytest_doctest_custom.pretty(value, max_width=12)
+        assert result == "\n".join([
+          "{'a': [(1,",
+          "        2)],",
+          " 'k': {0,",
+          "       1,",
+          "       2,",
+          "       3}}",
+        ])
+
+    def test_deep_and_recursive(self):
+        deep = []
+        for unused in range(sys.getrecursionlimit() * 2):
+            deep = [deep]
+        result = pytest_doctest_custom.pretty(deep)
+        assert result == "[" * len(result.split("]")[0]) + \
+                         "]" * len(result.split("]")[0])
+        recursive = {1: []}
+        recursive[1].append(recursive)
+        assert pytest_doctest_custom.pretty(recursive) == "{1: [{...}]}"
+
+    def test_hash_seed_independence(self):
+        import subprocess
+        code = "\n".join([
+          "from pytest_doctest_custom import pretty",
+          "sets = [frozenset(), frozenset('a'), frozenset('b'),",
+          "        frozenset('cd')]",
+          "print(pretty([set(sets), dict.fromkeys((s, 1) for s in sets)]))",
+        ])
+        results = set()
+        for seed in ["1", "2", "3", "4"]:
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            process = subprocess.Popen([sys.executable, "-c", code], env=env,
+                                       stdout=subprocess.PIPE,
+                                       cwd=os.path.dirname(
+                                         pytest_doctest_custom.__file__))
+            results.add(process.communicate()[0].decode("ascii"))
+        assert results == set(["\n".join([
+          "[{frozenset(), frozenset({'a'}), frozenset({'b'}), "
+          "frozenset({'c', 'd'})},",
+          " {(frozenset(), 1): None,",
+          "  (frozenset({'a'}), 1): None,",
+          "  (frozenset({'b'}), 1): None,",
+          "  (frozenset({'c', 'd'}), 1): None}]",
+          "",
+        ])])
+
+
 class TestReprAddress(object):
+    src = '''
+        """
+        >>> 2 + 2
+        4
+        """
+    '''
     msg_import = "ERROR: *ImportError* No module named *{module}*"
     msg_attr = "ERROR: *AttributeError* *{obj}* has no attribute '{attr}'"
 
-    def run_and_assert_stderr_msg_stout_empty(self, td, msg, address, **kws):
+    def run_and_assert_stderr_msg_none_ran(self, td, msg, address, **kws):
         args = "--doctest-repr=" + address, "--verbose", "--doctest-modules"
         address_split = address.split(":")
         attr_raw_split = address_split.pop().split(".")
@@ -429,54 +579,65 @@ class TestReprAddress(object):
         keys = {"module": module, "obj": obj, "attr": attr}
         keys.update(kws)
 
+        td.makepyfile(self.src) # The address is resolved only for doctests
         result = td.runpytest(*args)
         result.stderr.fnmatch_lines(msg.format(**keys))
         assert "\n" not in result.stderr.str().strip() # Only one stderr line
-        assert result.stdout.str().strip() == ""
+        result.assert_outcomes(passed=0, skipped=0, failed=0)
+
+    def test_no_doctest_to_run(self, testdir):
+        testdir.makepyfile(self.src + '''
+        def test_nothing():
+            pass
+        ''')
+        result = testdir.runpytest("--doctest-repr=os:sys:version",
+                                   "--doctest-modules", "-k", "nothing")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+        assert result.stderr.str().strip() == ""
 
     def test_import_error_not_nested(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir, self.msg_import,
+        self.run_and_assert_stderr_msg_none_ran(testdir, self.msg_import,
             address = "areallybadnameunavailable_____this_shouldnt_exist:obj")
 
     def test_import_error_nested_first(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir, self.msg_import,
+        self.run_and_assert_stderr_msg_none_ran(testdir, self.msg_import,
             address = "areallybadnameunavailable_____this_isnt.something:yet",
             module = "areallybadnameunavailable_____this_isnt")
 
     def test_import_error_nested_middle(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir, self.msg_import,
+        self.run_and_assert_stderr_msg_none_ran(testdir, self.msg_import,
             address = "sys.blablablablablah_blhaah.meeeh:obj",
             module = "blablablablablah_blhaah")
 
     def test_import_error_nested_last(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir, self.msg_import,
+        self.run_and_assert_stderr_msg_none_ran(testdir, self.msg_import,
             address = "os.path.heeeeeey:data",
             module = "heeeeeey")
 
     def test_attribute_error_builtin_not_nested(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir, self.msg_attr,
+        self.run_and_assert_stderr_msg_none_ran(testdir, self.msg_attr,
             address = "some_builtin_objThatDoesntExist_atAll")
 
     def test_attribute_error_builtin_nested(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir, self.msg_attr,
+        self.run_and_assert_stderr_msg_none_ran(testdir, self.msg_attr,
             address = "str.fakyjoint")
 
     def test_attribute_error_not_nested(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir, self.msg_attr,
+        self.run_and_assert_stderr_msg_none_ran(testdir, self.msg_attr,
             address = "os.path:oh_i_dont_likeIT")
 
     def test_attribute_error_nested(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir, self.msg_attr,
+        self.run_and_assert_stderr_msg_none_ran(testdir, self.msg_attr,
             address = "itertools:chain.from_iterable.myself",
             obj = "function" if PYPY else "builtin_function_or_method")
 
     def test_empty(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir,
+        self.run_and_assert_stderr_msg_none_ran(testdir,
             msg = "ERROR: *ValueError* Empty doctest-repr address",
             address = "")
 
     def test_multiple_colon(self, testdir):
-        self.run_and_assert_stderr_msg_stout_empty(testdir,
+        self.run_and_assert_stderr_msg_none_ran(testdir,
             msg = "ERROR: *ValueError* Multiple colon in doctest-repr address",
             address = "os:sys:version")
 
@@ -586,6 +747,1390 @@ class TestDoctestOutputsNone(object):
         ])
 
 
+class TestLazyFormatterImport(object):
+    src_heavy = '''
+        raise ImportError("The heavy module was imported")
+        def fmt(value):
+            return repr(value)
+    '''
+    src = '''
+        """
+        >>> 2 + 2
+        4
+        """
+        def test_sum():
+            assert 2 + 2 == 4
+    '''
+
+    def run(self, td, *args):
+        td.makepyfile(heavy=self.src_heavy)
+        td.makepyfile(self.src)
+        return td.runpytest("--doctest-repr=heavy:fmt", "--ignore=heavy.py",
+                            *args)
+
+    def test_unit_tests_only(self, testdir, here):
+        result = self.run(testdir, "--doctest-modules", "-k", "test_sum")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_without_doctest_modules(self, testdir, here):
+        result = self.run(testdir)
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_collect_only(self, testdir, here):
+        result = self.run(testdir, "--doctest-modules", "--collect-only")
+        assert result.ret == 0
+
+    def test_doctest_imports(self, testdir, here):
+        result = self.run(testdir, "--doctest-modules")
+        result.stderr.fnmatch_lines("ERROR: *ImportError* "
+                                    "The heavy module was imported")
+
+
+class TestStreamingFormatter(object):
+    src_conftest = '''
+        consumed = []
+        def stream_repr(value):
+            text = repr(value)
+            for idx in range(0, len(text), 5):
+                consumed.append(idx)
+                yield text[idx:idx + 5]
+        def lines_repr(value):
+            for item in value:
+                yield repr(item) + "\\n"
+    '''
+    src_pass = '''
+        """
+        >>> list(range(12))
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+        >>> print("Some text"); {"a": 1}
+        Some text
+        {'a': 1}
+        >>> list(range(1000)) # doctest: +ELLIPSIS
+        [0, 1, 2, ..., 999]
+        >>> list(range(12)) # doctest: +NORMALIZE_WHITESPACE
+        [0, 1, 2, 3,
+         4, 5, 6, 7,
+         8, 9, 10, 11]
+        """
+    '''
+    src_fail = '''
+        """
+        >>> list(range(10 ** 6))
+        [0, 1, 2, 3]
+        """
+        def check_consumed():
+            """
+            >>> import conftest
+            >>> len(conftest.consumed) < 10
+            True
+            """
+    '''
+    args = "--doctest-repr=conftest:stream_repr", "--doctest-modules"
+
+    def test_stream_pass(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src_pass)
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_stream_lines(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile('''
+            """
+            >>> [1, 2]
+            1
+            2
+            >>> []
+            <BLANKLINE>
+            """
+        ''')
+        result = testdir.runpytest("--doctest-repr=conftest:lines_repr",
+                                   "--doctest-modules")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_stream_early_stop(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src_fail)
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=1, skipped=0, failed=1)
+        result.stdout.fnmatch_lines([
+          "Expected:",
+          "    [0, 1, 2, 3]",
+          "Got:",
+          "    [0, 1, 2, 3, 4,",
+          "    <doctest-repr stream stopped: *>",
+        ])
+        assert "Expected:\n    True" not in result.stdout.str()
+
+    @pytest.mark.parametrize(("want", "flags", "chunks", "ok"), [
+      ("abc\n", 0, ["ab", "c"], True),
+      ("abc\n", 0, ["ab", "d"], False),
+      ("abc\n", 0, ["abc", "\nx"], False),
+      ("a b\n", "NORMALIZE_WHITESPACE", ["a", "  ", "b"], True),
+      ("a b\n", "NORMALIZE_WHITESPACE", ["a", "b"], False),
+      ("[1, ..., 9]\n", "ELLIPSIS", ["[1, 2", ", 3, ", "8, 9]"], True),
+      ("[1, ..., 9]\n", "ELLIPSIS", ["[2, ", "3]"], False),
+      ("<BLANKLINE>\n", 0, ["x"], True),
+    ])
+    def test_stream_checker(self, want, flags, chunks, ok):
+        import doctest
+        optionflags = getattr(doctest, flags) if flags else 0
+        checker = pytest_doctest_custom.StreamChecker(want, optionflags)
+        assert all(checker.feed(chunk) for chunk in chunks) == ok
+
+
+class TestReprType(object):
+    src_conftest = '''
+        class Base(object):
+            def __repr__(self):
+                return type(self).__name__
+        class Derived(Base):
+            pass
+        def shout(value):
+            return repr(value).upper()
+        def brackets(value):
+            return "<%r>" % value
+    '''
+    src = '''
+        """
+        >>> from conftest import Base, Derived
+        >>> "Hello"
+        'HELLO'
+        >>> Base(), Derived()
+        (Base, Derived)
+        >>> Derived()
+        <Derived>
+        >>> [Derived()]
+        [Derived]
+        """
+    '''
+    args = ("--doctest-modules", "--doctest-repr-type=str=conftest:shout",
+            "--doctest-repr-type", "conftest:Base=conftest:brackets")
+
+    def test_cli(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_ini(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src)
+        testdir.makeini("""
+            [pytest]
+            doctest_repr_types = str=conftest:shout
+                                 conftest:Base = conftest:brackets
+        """)
+        result = testdir.runpytest("--doctest-modules")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_default_formatter(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile('''
+            """
+            >>> from conftest import Derived
+            >>> [Derived(), "Hi"]
+            [DERIVED, 'HI']
+            >>> Derived()
+            <Derived>
+            """
+        ''')
+        result = testdir.runpytest("--doctest-repr=conftest:shout",
+                                   *self.args)
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_missing_equal_sign(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr-type=str:conftest:shout")
+        result.stderr.fnmatch_lines("ERROR: *ValueError* Missing '=' in "
+                                    "doctest-repr-type entry")
+
+    def test_dispatcher_cache(self):
+        dispatcher = pytest_doctest_custom.TypeDispatcher(repr, {int: hex})
+        assert dispatcher(True) == "0x1"
+        assert dispatcher(2.5) == "2.5"
+        assert dispatcher.cache == {int: hex, bool: hex, float: repr}
+
+
+class TestReprConfig(object):
+    src_root_conftest = '''
+        def shout(value):
+            return repr(value).upper()
+        def brackets(value):
+            return "<%r>" % (value,)
+    '''
+    src_conftest = '''
+        def pytest_doctest_repr(item):
+            if not item.name.endswith("keep"):
+                return "conftest:brackets"
+    '''
+    src_root = '''
+        """
+        >>> "Hi"
+        'HI'
+        """
+    '''
+    src_sub = '''
+        def change():
+            """
+            >>> "Hi", 2
+            <('Hi', 2)>
+            """
+        def keep():
+            """
+            >>> "Hi", 2
+            ('HI', 2)
+            """
+    '''
+    ini = """
+        [pytest]
+        doctest_repr = conftest:{0}
+    """
+
+    def test_ini(self, testdir):
+        testdir.makeconftest(self.src_root_conftest)
+        testdir.makepyfile(mod_root=self.src_root)
+        testdir.makeini(self.ini.format("shout"))
+        result = testdir.runpytest("--doctest-modules")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_cli_overrides_ini(self, testdir):
+        testdir.makeconftest(self.src_root_conftest)
+        testdir.makepyfile(mod_root=self.src_root)
+        testdir.makeini(self.ini.format("brackets"))
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr=conftest:shout")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    @pytest.mark.parametrize("args", [
+      (),
+      ("--doctest-repr-cache=10",),
+      ("--doctest-context-local",),
+    ])
+    def test_conftest_hook(self, testdir, args):
+        testdir.makeconftest(self.src_root_conftest)
+        testdir.mkpydir("sub")
+        testdir.makepyfile(**{
+          "mod_root": self.src_root,
+          "sub/conftest": self.src_conftest,
+          "sub/mod_sub": self.src_sub,
+        })
+        testdir.makeini(self.ini.format("shout"))
+        result = testdir.runpytest("--doctest-modules", *args)
+        result.assert_outcomes(passed=3, skipped=0, failed=0)
+
+    def test_resolve_once(self, monkeypatch):
+        import pprint
+        calls = []
+        parse_address = pytest_doctest_custom.parse_address
+        monkeypatch.setattr(pytest_doctest_custom, "parse_address",
+                            lambda address: calls.append(address) or
+                                            parse_address(address))
+        config = type("Config", (object,), {
+          "_doctest_formatters": {},
+          "_doctest_types": {},
+          "_doctest_repr_cache": None,
+        })()
+        resolve = pytest_doctest_custom.resolve_formatter
+        assert resolve(config, "pprint:pformat") is pprint.pformat
+        assert resolve(config, None) is repr
+        assert resolve(config, "pprint:pformat") is pprint.pformat
+        assert calls == ["pprint:pformat", "repr"]
+
+
+class TestNDArrayRepr(object):
+    @pytest.fixture
+    def numpy(self): # Imported before the testdir sys.modules snapshot
+        return pytest.importorskip("numpy")
+
+    src_conftest = '''
+        import numpy
+        numpy.set_printoptions(precision=2, threshold=10 ** 6, suppress=True)
+        from pytest_doctest_custom import NDArrayFormatter
+        short_repr = NDArrayFormatter(fallback="str.upper", threshold=5,
+                                      edgeitems=2)
+    '''
+    src_numpy = '''
+        """
+        >>> import numpy
+        >>> numpy.arange(10000) # doctest: +ELLIPSIS
+        array([   0,    1,    2, ..., 9997, 9998, 9999]...)
+        >>> numpy.array([1 / 3.])
+        array([0.33333333])
+        >>> numpy.array([1e-10, 1.])
+        array([1.e-10, 1.e+00])
+        >>> "Hi"
+        'Hi'
+        """
+    '''
+    src_short = '''
+        """
+        >>> import numpy
+        >>> numpy.arange(10) # doctest: +ELLIPSIS
+        array([0, 1, ..., 8, 9]...)
+        >>> "Hi"
+        HI
+        """
+    '''
+    src_no_numpy = '''
+        """
+        >>> class FakeArray(object):
+        ...     dtype = shape = None
+        ...     def __array__(self):
+        ...         raise RuntimeError("Shouldn't be called")
+        ...     def __repr__(self):
+        ...         return "FakeArray()"
+        >>> FakeArray(), "Hi"
+        (FakeArray(), 'Hi')
+        >>> import sys
+        >>> "numpy" in sys.modules
+        False
+        """
+    '''
+
+    def test_no_numpy_import(self, testdir):
+        if "numpy" in sys.modules:
+            pytest.skip("NumPy was already imported")
+        testdir.makepyfile(self.src_no_numpy)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr",
+                                   "pytest_doctest_custom:ndarray_repr")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_numpy(self, numpy, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src_numpy)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr",
+                                   "pytest_doctest_custom:ndarray_repr")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_options_fallback(self, numpy, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src_short)
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr=conftest:short_repr")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+
+class TestReprCache(object):
+    src = '''
+        """
+        >>> 2 ** 10
+        1024
+        >>> 2 ** 10
+        1024
+        >>> [1, (2.5, "a"), {"b": None}]
+        [1, (2.5, 'a'), {'b': None}]
+        >>> [1, (2.5, "a"), {"b": None}]
+        [1, (2.5, 'a'), {'b': None}]
+        >>> 0.0
+        0.0
+        >>> -0.0
+        -0.0
+        >>> type("A", (object,), {"__repr__": lambda self: "A!"})()
+        A!
+        """
+    '''
+
+    def run_and_assert_summary(self, td, maxsize, summary):
+        td.makepyfile(self.src)
+        result = td.runpytest("--verbose", "--doctest-modules",
+                              "--doctest-repr=repr",
+                              "--doctest-repr-cache=%d" % maxsize)
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+        result.stdout.fnmatch_lines(["*doctest-repr cache*", summary])
+
+    def test_hits(self, testdir):
+        self.run_and_assert_summary(testdir, maxsize=10,
+            summary="2 hits, 4 misses, 0 evictions, 1 uncacheable*")
+
+    def test_evictions(self, testdir):
+        self.run_and_assert_summary(testdir, maxsize=1,
+            summary="2 hits, 4 misses, 3 evictions, 1 uncacheable*")
+
+    def test_disabled(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=repr")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+        assert "doctest-repr cache" not in result.stdout.str()
+
+    def test_fingerprint(self):
+        fingerprint = pytest_doctest_custom.fingerprint
+        assert fingerprint([1, 2]) != fingerprint((1, 2))
+        assert fingerprint([1, 2]) != fingerprint([1, 2.0])
+        assert fingerprint([True]) != fingerprint([1])
+        assert fingerprint(0.0) != fingerprint(-0.0)
+        assert fingerprint({"a": [1]}) == fingerprint({"a": [1]})
+        assert fingerprint([object()]) is None
+        assert fingerprint(list(range(5)), max_items=3) is None
+        cyclic = []
+        cyclic.append(cyclic)
+        assert fingerprint(cyclic) is None
+
+    def test_key_size(self):
+        cache = pytest_doctest_custom.ReprCache(repr, 10, 10 ** 6)
+        cache(list(range(1000)))
+        cache([1])
+        assert all(len(key) == 40 for key in cache.data)
+        assert cache.nbytes == sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                   for key, value in cache.data.items())
+
+
+class TestDoctestWorkers(object):
+    src = '''
+        """
+        >>> "This IS a TEsT! =D"
+        this is a test! =d
+        """
+        def shout(text):
+            """
+            >>> shout("Hey")
+            hey!
+            """
+            return text.upper() + "!"
+    '''
+    args = "--doctest-modules", "--doctest-repr=str.lower"
+
+    @pytest.mark.skipif(not XDIST, reason="pytest-xdist isn't installed")
+    def test_workers(self, testdir):
+        testdir.makepyfile(mod_a=self.src, mod_b=self.src)
+        result = testdir.runpytest("--doctest-workers=2", *self.args)
+        result.assert_outcomes(passed=4, skipped=0, failed=0)
+
+    def test_without_xdist(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("-p", "no:xdist", "--doctest-workers=2",
+                                   *self.args)
+        result.stderr.fnmatch_lines("ERROR: *ImportError* --doctest-workers "
+                                    "requires the pytest-xdist plugin")
+
+
+class TestDoctestIncremental(object):
+    src = '''
+        def shout(text):
+            """
+            >>> shout("Hey")
+            'HEY!'
+            """
+            return text.upper() + "!"
+        def whisper(text):
+            """
+            >>> whisper("Hey")
+            'hey.'
+            """
+            return text.lower() + "?"
+    '''
+    args = "--doctest-modules", "--doctest-repr=repr", "--doctest-incremental"
+
+    def test_cached_pass(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=1, skipped=0, failed=1)
+        result = testdir.runpytest("-rs", *self.args)
+        result.assert_outcomes(passed=0, skipped=1, failed=1)
+        result.stdout.fnmatch_lines([
+          "*doctest incremental*",
+          "1 unchanged doctests skipped as cached",
+          "*cached (passed before, unchanged)*",
+        ])
+
+    def test_source_change(self, testdir):
+        testdir.makepyfile(self.src)
+        testdir.runpytest(*self.args).assert_outcomes(passed=1, failed=1)
+        testdir.makepyfile(self.src.replace('"?"', '"."'))
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=2, skipped=0, failed=0)
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=0, skipped=2, failed=0)
+
+    def test_repr_change(self, testdir):
+        testdir.makepyfile(self.src)
+        testdir.runpytest(*self.args).assert_outcomes(passed=1, failed=1)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=ascii",
+                                   "--doctest-incremental")
+        result.assert_outcomes(passed=1, skipped=0, failed=1)
+
+
+class TestExampleCache(object):
+    src = '''
+        def double(value):
+            """
+            >>> x = 3
+            >>> double(x)
+            6
+            >>> [double(x)] * 2  # doctest: +NORMALIZE_WHITESPACE
+            [6,   6]
+            """
+            return value * 2
+    '''
+    args = "--doctest-modules", "--doctest-example-cache"
+
+    def run_and_assert_summary(self, td, summary, *args, **kwargs):
+        outcomes = dict(passed=1, skipped=0, failed=0)
+        outcomes.update(kwargs)
+        result = td.runpytest(*self.args + args)
+        result.assert_outcomes(**outcomes)
+        result.stdout.fnmatch_lines(["*doctest example cache*", summary])
+
+    def test_hits(self, testdir):
+        testdir.makepyfile(self.src)
+        self.run_and_assert_summary(testdir,
+            "parse: 0 hits, 1 misses; compile: 0 hits, 3 misses")
+        self.run_and_assert_summary(testdir,
+            "parse: 1 hits, 0 misses; compile: 3 hits, 0 misses")
+        self.run_and_assert_summary(testdir,
+            "parse: 0 hits, 1 misses; compile: 0 hits, 3 misses",
+            "--doctest-example-cache-clear")
+
+    def test_changed_docstring(self, testdir):
+        testdir.makepyfile(self.src)
+        self.run_and_assert_summary(testdir,
+            "parse: 0 hits, 1 misses; compile: 0 hits, 3 misses")
+        testdir.makepyfile(self.src.replace("6,   6", "6, 7"))
+        self.run_and_assert_summary(testdir,
+            "parse: 0 hits, 1 misses; compile: 3 hits, 0 misses",
+            passed=0, failed=1)
+
+    def test_prune(self, testdir, monkeypatch):
+        monkeypatch.setattr(pytest_doctest_custom.ExampleCache, "max_age", 2)
+        sources = [self.src, self.src.replace("x = 3", "x = 1 + 2"),
+                   self.src.replace("x = 3", "x = 2 + 1"), self.src]
+        summaries = [
+          "parse: 0 hits, 1 misses; compile: 0 hits, 3 misses",
+          "parse: 0 hits, 1 misses; compile: 2 hits, 1 misses",
+          "parse: 0 hits, 1 misses; compile: 2 hits, 1 misses",
+          "parse: 0 hits, 1 misses; compile: 2 hits, 1 misses", # Pruned
+        ]
+        for src, summary in zip(sources, summaries):
+            testdir.makepyfile(src)
+            self.run_and_assert_summary(testdir, summary)
+
+
+class TestStaticScan(object):
+    src_heavy = '''
+        def double(value): # >>> in a comment isn't an example
+            return value * 2
+        raise ImportError("This module shouldn't be imported")
+    '''
+    src_example = '''
+        def double(value):
+            """
+            >>> double(2)
+            4
+            """
+            return value * 2
+    '''
+    src_dynamic = '''
+        def double(value):
+            return value * 2
+        double.__doc__ = ">" * 3 + " double(2)\\n4\\n"
+    '''
+    src_test = '''
+        def test_double():
+            assert 2 * 2 == 4
+    '''
+
+    def test_skip_heavy(self, testdir):
+        testdir.makepyfile(heavy=self.src_heavy, example=self.src_example,
+                           dynamic=self.src_dynamic, test_it=self.src_test)
+        for unused in range(2): # The 2nd run uses the index
+            result = testdir.runpytest("--doctest-modules",
+                                       "--doctest-static-scan")
+            result.assert_outcomes(passed=3, skipped=0, failed=0)
+            result.stdout.fnmatch_lines([
+              "*doctest static scan*",
+              "2 modules without examples not imported, saving *s (known) "
+                "in *s of scanning",
+            ])
+
+    def test_saved_time(self, testdir):
+        src_slow = "import time\ntime.sleep(0.3)\n{0}"
+        for doc in ['"""\n>>> 1\n1\n"""', ""]: # The 2nd run skips it
+            testdir.makepyfile(slow=src_slow.format(doc))
+            result = testdir.runpytest("--doctest-modules",
+                                       "--doctest-static-scan")
+        match = re.search(r"1 modules without examples not imported, "
+                          r"saving (\S+)s", result.stdout.str())
+        assert float(match.group(1)) >= 0.3
+
+    def test_disabled(self, testdir):
+        testdir.makepyfile(heavy=self.src_heavy)
+        result = testdir.runpytest("--doctest-modules")
+        result.stdout.fnmatch_lines("*ImportError*shouldn't be imported*")
+
+    @pytest.mark.parametrize(("source", "expected"), [
+      (b"x = 1  # >>> 1", False),
+      (b"def f():\n    '''\n    >>> f()\n    '''", True),
+      (b"setattr(f, '__doc__', doc)", True),
+      (b"from functools import wraps", True),
+      (b"x = [1 >>> 2", True), # Syntax error, the import will raise
+    ])
+    def test_scan_examples(self, source, expected):
+        assert pytest_doctest_custom.scan_examples(source) is expected
+
+
+@pytest.mark.skipif("sys.version_info < (3, 3)")
+class TestLayeredGlobals(object):
+    src = '''
+        import collections
+        value = 3
+        def first():
+            """
+            >>> value = 5
+            >>> del collections
+            >>> "collections" in globals(), "value" in globals(), value
+            (False, True, 5)
+            >>> collections
+            Traceback (most recent call last):
+              ...
+            NameError: name 'collections' is not defined
+            """
+        def second():
+            """
+            >>> value, "first" in globals(), len(globals()) > 5
+            (3, True, True)
+            >>> class Cls(object):
+            ...     deque = collections.deque
+            ...     twice = value * 2
+            >>> Cls.twice, Cls.deque([value])
+            (6, deque([3]))
+            >>> def get_value():
+            ...     return value
+            >>> get_value()
+            3
+            >>> import os
+            >>> from collections import deque
+            >>> os.path.join("a", "b"), deque([value])
+            ('a/b', deque([3]))
+            """
+        def third():
+            """
+            >>> del value
+            >>> value
+            Traceback (most recent call last):
+              ...
+            NameError: name 'value' is not defined
+            >>> "get_value" in globals()
+            False
+            """
+        def fourth():
+            """
+            >>> def drop():
+            ...     global value
+            ...     del value
+            >>> drop()
+            >>> "value" in globals()
+            False
+            >>> def store():
+            ...     global collections
+            ...     collections = 1
+            >>> store()
+            >>> collections, len
+            (1, <built-in function len>)
+            """
+    '''
+
+    @pytest.mark.parametrize("args", [(), ("--doctest-layered-globals",)])
+    def test_isolation(self, testdir, args):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules", *args)
+        result.assert_outcomes(passed=4, skipped=0, failed=0)
+
+    def test_copy(self):
+        base = {"a": 1, "b": 2}
+        globs = pytest_doctest_custom.LayeredGlobals(base)
+        globs["c"] = 3
+        del globs["a"]
+        copy = globs.copy()
+        copy["a"] = 4
+        del copy["b"]
+        assert type(copy) is pytest_doctest_custom.LayeredGlobals
+        assert (sorted(globs), globs.get("a"), globs["b"]) == \
+               (["__builtins__", "b", "c"], None, 2)
+        assert (sorted(copy), copy["a"], "b" in copy, copy.pop("c")) == \
+               (["__builtins__", "a", "c"], 4, False, 3)
+        assert base == {"a": 1, "b": 2}
+
+    def test_builtins(self):
+        globs = pytest_doctest_custom.LayeredGlobals({"len": 1, "a": 2})
+        layered_builtins = dict.__getitem__(globs, "__builtins__")
+        assert "__import__" in dict.keys(layered_builtins)
+        assert (layered_builtins["len"], layered_builtins["a"]) == (1, 2)
+        del globs["len"]
+        assert layered_builtins["len"] is len
+
+
+@pytest.mark.skipif("not hasattr(os, 'fork')")
+class TestDoctestFork(object):
+    src_first = '''
+        """
+        >>> import sys
+        >>> sys.doctest_fork_state = 1
+        """
+    '''
+    src_second = '''
+        """
+        >>> import sys
+        >>> hasattr(sys, "doctest_fork_state")
+        False
+        >>> "doctest_fork_heavy" in sys.modules
+        True
+        """
+        def test_state():
+            import sys
+            assert not hasattr(sys, "doctest_fork_state")
+    '''
+    src_crash = '''
+        def crash():
+            """
+            >>> import os
+            >>> os._exit(3)
+            """
+        def after_crash():
+            """
+            >>> 1
+            1
+            """
+    '''
+
+    def test_isolation_and_preload(self, testdir):
+        testdir.makepyfile(doctest_fork_heavy="value = 1",
+                           a_first=self.src_first, test_second=self.src_second)
+        result = testdir.runpytest("--doctest-modules", "--doctest-fork",
+                                   "--doctest-fork-preload",
+                                   "doctest_fork_heavy",
+                                   "--ignore=doctest_fork_heavy.py")
+        result.assert_outcomes(passed=3, skipped=0, failed=0)
+        result.stdout.fnmatch_lines([
+          "*doctest fork*",
+          "2 forked children (0 crashed doctests), *s preloading 1 modules",
+        ])
+
+    def test_crash(self, testdir):
+        testdir.makepyfile(self.src_crash)
+        result = testdir.runpytest("--doctest-modules", "--doctest-fork")
+        result.assert_outcomes(passed=1, skipped=0, failed=1)
+        result.stdout.fnmatch_lines([
+          "*doctest fork child process crashed (wait status 768)*",
+          "1 forked children (1 crashed doctests), *",
+        ])
+
+    def test_mixed_directories(self, testdir):
+        testdir.mkdir("a")
+        testdir.mkdir("b")
+        testdir.makepyfile(**{
+          "a/test_x": "def test_x():\n    pass",
+          "a/z_mod": self.src_first,
+          "b/test_y": "def test_y():\n    pass",
+        })
+        result = testdir.runpytest("--doctest-modules", "--doctest-fork")
+        result.assert_outcomes(passed=3, skipped=0, failed=0)
+
+    def test_collection_error(self, testdir):
+        testdir.makepyfile(a_first=self.src_first, b_broken="import nothing_")
+        result = testdir.runpytest("--doctest-modules", "--doctest-fork")
+        result.stdout.fnmatch_lines(["*Interrupted: 1 error during collect*"])
+        assert "forked children" not in result.stdout.str()
+
+    def test_maxfail(self, testdir):
+        testdir.makepyfile(a_fail="""
+            def first():
+                '''
+                >>> 1
+                2
+                '''
+            def second():
+                '''
+                >>> 1
+                2
+                '''
+        """, b_pass=self.src_first)
+        result = testdir.runpytest("--doctest-modules", "--doctest-fork",
+                                   "-x")
+        result.assert_outcomes(passed=0, skipped=0, failed=1)
+        result.stdout.fnmatch_lines(["1 forked children (0 crashed *"])
+
+    def test_collect_only(self, testdir):
+        testdir.makepyfile(self.src_first)
+        result = testdir.runpytest("--doctest-modules", "--doctest-fork",
+                                   "--collect-only")
+        assert "doctest fork" not in result.stdout.str()
+
+
+class TestReprDurations(object):
+    src = '''
+        def small():
+            """
+            >>> 7
+            7
+            """
+        def big():
+            """
+            >>> None
+            >>> list(range(20000))[-1:]
+            [19999]
+            >>> list(range(20000))  # doctest: +ELLIPSIS
+            [0, 1, 2, ...]
+            """
+    '''
+
+    def test_slowest(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=repr",
+                                   "--doctest-repr-durations=1")
+        result.assert_outcomes(passed=2, skipped=0, failed=0)
+        result.stdout.fnmatch_lines([
+          "*slowest 1 doctest-repr durations*",
+          "*s formatter / *s total (2 calls) *::test_slowest.big",
+          "    slowest call: *s builtins.list -> 128890 chars",
+        ])
+        assert "test_slowest.small" not in result.stdout.str()
+
+    def test_all_printer(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=print",
+                                   "--doctest-repr-durations=0")
+        result.assert_outcomes(passed=2, skipped=0, failed=0)
+        result.stdout.fnmatch_lines([
+          "*slowest doctest-repr durations*",
+          "*s formatter / *s total (2 calls) *::test_all_printer.big",
+          "    slowest call: *s builtins.list -> ? chars",
+          "*s formatter / *s total (1 calls) *::test_all_printer.small",
+        ])
+
+    def test_disabled(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=repr")
+        assert "doctest-repr durations" not in result.stdout.str()
+
+
+class TestDoctestMemory(object):
+    src = '''
+        cache = []
+        def leak():
+            """
+            >>> from test_leak import cache
+            >>> cache.append([0] * 500000)
+            """
+        def no_leak():
+            """
+            >>> data = [0] * 1000000
+            >>> len(data)
+            1000000
+            """
+        def small():
+            """
+            >>> 1
+            1
+            """
+    '''
+    src_conftest = '''
+        items = []
+        def pytest_collection_modifyitems(items):
+            globals()["items"] = items
+        def pytest_terminal_summary(terminalreporter):
+            terminalreporter.write_line("globals sizes: {0}".format(
+                [len(item.dtest.globs) for item in items]))
+    '''
+    src_skip = '''
+        def run():
+            """
+            >>> 1
+            1
+            """
+        def skip():
+            """
+            >>> 2 # doctest: +SKIP
+            2
+            """
+    '''
+
+    @pytest.mark.skipif("sys.version_info < (3, 4)")
+    def test_memory(self, testdir):
+        testdir.makepyfile(test_leak=self.src)
+        result = testdir.runpytest("--doctest-modules", "--doctest-memory=2")
+        result.assert_outcomes(passed=3, skipped=0, failed=0)
+        result.stdout.fnmatch_lines([
+          "*largest 2 doctest memory peaks*",
+          "* KiB peak, * KiB retained test_leak.py::test_leak.no_leak",
+          "* KiB peak, * KiB retained test_leak.py::test_leak.leak",
+        ])
+        regex = r"([\d.]+) KiB peak, ([\d.]+) KiB retained .*\.(\w+)$"
+        data = dict((match.group(3), (float(match.group(1)),
+                                      float(match.group(2))))
+                    for match in map(re.compile(regex).match,
+                                     result.stdout.lines) if match)
+        assert sorted(data) == ["leak", "no_leak"]
+        assert data["no_leak"][0] > 7000 > data["no_leak"][1]
+        assert data["leak"][1] > 3500
+
+    @pytest.mark.parametrize(("args", "sizes"), [
+      ((), "?0, 1*"), # The brackets would be a fnmatch pattern
+      (("--doctest-clear-globals",), "?0, 0?"),
+    ])
+    def test_clear_globals(self, testdir, args, sizes):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src_skip)
+        result = testdir.runpytest("--doctest-modules", *args)
+        result.assert_outcomes(passed=1, skipped=1, failed=0)
+        result.stdout.fnmatch_lines("globals sizes: " + sizes)
+
+
+class TestDoctestProfile(object):
+    src_conftest = '''
+        def slow_repr(value):
+            sum(range(300000))
+            return repr(value)
+    '''
+    src = '''
+        def slow_computed():
+            """
+            >>> total = sum(range(1000000))
+            """
+        def slow_formatted():
+            """
+            >>> 1
+            1
+            """
+        def other():
+            """
+            >>> 2
+            2
+            """
+        def slow_recursive():
+            """
+            >>> def fib(n):
+            ...     return n if n < 2 else fib(n - 1) + fib(n - 2)
+            >>> fib(20)
+            6765
+            """
+    '''
+    regex = (r"([\d.]+)s total: ([\d.]+)s example code, ([\d.]+)s formatter,"
+             r" ([\d.]+)s doctest .*\.(\w+)$")
+
+    def test_profile(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr=conftest:slow_repr",
+                                   "--doctest-profile=*::*.slow_*",
+                                   "--doctest-profile-dir=prof")
+        result.assert_outcomes(passed=4, skipped=0, failed=0)
+        result.stdout.fnmatch_lines([
+          "*doctest profile*",
+          "hot functions (by own time):",
+          "    *s * calls *",
+          "pstats files written to prof",
+        ])
+        data = dict((match.group(5), tuple(map(float, match.groups()[:4])))
+                    for match in map(re.compile(self.regex).match,
+                                     result.stdout.lines) if match)
+        assert sorted(data) == ["slow_computed", "slow_formatted",
+                                "slow_recursive"]
+        total, example, formatter, machinery = data["slow_computed"]
+        assert example > max(formatter, machinery)
+        total, example, formatter, machinery = data["slow_formatted"]
+        assert formatter > max(example, machinery)
+        total, example, formatter, machinery = data["slow_recursive"]
+        assert total >= example > max(formatter, machinery)
+        assert sorted(os.listdir(str(testdir.tmpdir.join("prof")))) == [
+          "combined.pstats",
+          "test_profile.py_test_profile.slow_computed.pstats",
+          "test_profile.py_test_profile.slow_formatted.pstats",
+          "test_profile.py_test_profile.slow_recursive.pstats",
+        ]
+
+
+class TestDoctestRunner(object):
+    src = '''
+        """
+        >>> "This IS a TEsT! =D"
+        this is a test! =d
+        """
+        import doctest
+        def test_other_runner():
+            text = ">>> 'This IS a TEsT! =D'\\n'This IS a TEsT! =D'\\n"
+            test = doctest.DocTestParser().get_doctest(text, {}, "t", "t", 0)
+            runner = doctest.DocTestRunner()
+            runner.run(test)
+            assert runner.failures == 0
+    '''
+
+    def test_other_runner_unchanged(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr=str.lower")
+        result.assert_outcomes(passed=2, skipped=0, failed=0)
+
+    def test_runner_class(self):
+        import doctest
+        runner_class = pytest_doctest_custom.runner_class
+        cls = runner_class(doctest.DebugRunner)
+        assert issubclass(cls, doctest.DebugRunner)
+        assert runner_class(doctest.DebugRunner) is cls
+        assert runner_class(doctest.DocTestRunner) is not cls
+        assert runner_class(doctest.DebugRunner, True) is not cls
+
+
+class TestContextLocal(object):
+    def test_str_lower(self, testdir):
+        testdir.makepyfile(TestStrLowerAsRepr.src_pass)
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-context-local",
+                                   "--doctest-repr=str.lower")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_concurrent_runners(self):
+        import doctest, threading
+        runner_class = pytest_doctest_custom.runner_class
+        cls = runner_class(doctest.DocTestRunner, context_local=True)
+        parser = doctest.DocTestParser()
+        results = {}
+        def run_doctests(name, formatter, want):
+            runner = cls()
+            runner._doctest_repr = formatter
+            for idx in range(300):
+                count = idx % 3 + 1
+                text = ">>> 'Ab' * {0}\n{1}\n".format(count, want * count)
+                test = parser.get_doctest(text, {}, name, name, 0)
+                runner.run(test, out=lambda msg: None)
+            results[name] = runner.failures, runner.tries
+        threads = [
+          threading.Thread(target=run_doctests, args=("up", str.upper, "AB")),
+          threading.Thread(target=run_doctests, args=("low", str.lower, "ab")),
+        ]
+        displayhook, stdout = sys.displayhook, sys.stdout
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {"up": (0, 300), "low": (0, 300)}
+        assert (sys.displayhook, sys.stdout) == (displayhook, stdout)
+
+
+class TestReprLimits(object):
+    src = '''
+        """
+        >>> list(range(5))
+        [0, 1, 2, 3, 4]
+        >>> list(range(10 ** 5))
+        [0, 1, 2, ...]
+        """
+    '''
+
+    def test_max_bytes(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=repr",
+                                   "--doctest-repr-max-bytes=100")
+        result.assert_outcomes(passed=0, skipped=0, failed=1)
+        result.stdout.fnmatch_lines("*OutputLimitError*the list "
+                                    "representation exceeds the "
+                                    "--doctest-repr-max-bytes=100 limit*")
+
+    def test_default_formatter(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr-max-bytes=100")
+        result.assert_outcomes(passed=0, skipped=0, failed=1)
+        result.stdout.fnmatch_lines("*OutputLimitError*the list "
+                                    "representation exceeds the "
+                                    "--doctest-repr-max-bytes=100 limit*")
+
+    def test_max_lines_printer(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr=pprint:pprint",
+                                   "--doctest-repr-max-lines=3")
+        result.assert_outcomes(passed=0, skipped=0, failed=1)
+        result.stdout.fnmatch_lines("*OutputLimitError*the list "
+                                    "representation exceeds the "
+                                    "--doctest-repr-max-lines=3 limit*")
+
+    def test_within_limits(self, testdir):
+        testdir.makepyfile(self.src.replace("10 ** 5", "3")
+                                   .replace("2, ...", "2"))
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=repr",
+                                   "--doctest-repr-max-bytes=100",
+                                   "--doctest-repr-max-lines=1")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_limited_stream(self):
+        stream = StringIO()
+        limited = pytest_doctest_custom.LimitedStream(stream, max_lines=2)
+        limited.write("a\nb")
+        with pytest.raises(pytest_doctest_custom.OutputLimitError):
+            limited.write("\nc\n")
+        assert stream.getvalue() == "a\nb\n"
+
+    def test_limited_stream_bytes(self):
+        stream = StringIO()
+        limited = pytest_doctest_custom.LimitedStream(stream, max_bytes=4)
+        limited.write(u"a\xe1")
+        with pytest.raises(pytest_doctest_custom.OutputLimitError):
+            limited.write(u"\xe9b")
+        assert stream.getvalue() == u"a\xe1"
+
+
+class TestReprTimeout(object):
+    src = '''
+        """
+        >>> import time
+        >>> class Slow(object):
+        ...     def __repr__(self):
+        ...         deadline = time.time() + 10
+        ...         while time.time() < deadline:
+        ...             pass
+        ...         return "Slow"
+        >>> [1, 2]
+        [1, 2]
+        >>> Slow()
+        Slow
+        """
+    '''
+
+    @staticmethod
+    def slow_show(value):
+        import time
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            pass
+
+    def test_alarm(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr-timeout=0.2")
+        result.assert_outcomes(passed=0, skipped=0, failed=1)
+        result.stdout.fnmatch_lines([
+          "*>>> Slow()",
+          "*ReprTimeoutError: the Slow representation took 0.2*s, "
+          "exceeding the 0.2s timeout",
+        ])
+
+    def test_within_timeout(self, testdir):
+        testdir.makepyfile(self.src.replace("+ 10", "+ 0.05"))
+        result = testdir.runpytest("--doctest-modules",
+                                   "--doctest-repr-timeout=0.2")
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_formatter_value_error(self):
+        calls = []
+        def show(value):
+            calls.append(value)
+            raise ValueError(value)
+        timeout = pytest_doctest_custom.ReprTimeout(show, 1)
+        with pytest.raises(ValueError):
+            timeout(5)
+        assert calls == [5]
+
+    @pytest.mark.skipif(pytest_doctest_custom.async_exc_setter() is None,
+                        reason="Can't raise exceptions in other threads")
+    def test_thread(self):
+        import threading, time
+        errors = []
+        def target():
+            timeout = pytest_doctest_custom.ReprTimeout(len, 0.1)
+            assert timeout([1, 2]) == 2
+            time.sleep(0.2) # The cancelled timer shouldn't interrupt it
+            timeout.show = self.slow_show
+            try:
+                timeout({})
+            except Exception as exc:
+                errors.append(exc)
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert len(errors) == 1
+        assert isinstance(errors[0], pytest_doctest_custom.ReprTimeoutError)
+        assert str(errors[0]).startswith("the dict representation took 0.1")
+
+
+class TestCompareLiterals(object):
+    src_conftest = '''
+        calls = []
+        def counting(value):
+            calls.append(value)
+            return repr(value)
+    '''
+    src = '''
+        """
+        >>> {"b": 1, "a": [2, (3, None)]}
+        {'a': [2, (3, None)], 'b': 1}
+        >>> "text", -0.5
+        ('text', -0.5)
+        >>> from conftest import calls
+        >>> len(calls)
+        0
+        >>> object # doctest: +ELLIPSIS
+        <... 'object'>
+        >>> len(calls)
+        1
+        """
+    '''
+    src_mismatch = '''
+        """
+        >>> 1
+        1.0
+        """
+        def other():
+            """
+            >>> [1, 2]
+            [1, 2, 3]
+            """
+    '''
+    args = ("--doctest-modules", "--doctest-repr=conftest:counting",
+            "--doctest-compare-literals")
+
+    def test_compare_literals(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=1, skipped=0, failed=0)
+
+    def test_without_option(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest(*self.args[:-1])
+        result.assert_outcomes(passed=0, skipped=0, failed=1)
+        result.stdout.fnmatch_lines([
+          "Expected:",
+          "    {'a': [2, (3, None)], 'b': 1}",
+          "Got:",
+          "    {'b': 1, 'a': [2, (3, None)]}",
+        ])
+
+    def test_mismatch(self, testdir):
+        testdir.makeconftest(self.src_conftest)
+        testdir.makepyfile(self.src_mismatch)
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=0, skipped=0, failed=2)
+        result.stdout.fnmatch_lines([
+          "Expected:",
+          "    1.0",
+          "Got:",
+          "    1",
+          "*",
+          "Expected:",
+          "    ?1, 2, 3?",
+          "Got:",
+          "    ?1, 2?",
+        ])
+
+    def test_unordered_fingerprint(self):
+        fingerprint = pytest_doctest_custom.fingerprint
+        assert fingerprint({1: 2, 3: 4}, unordered=True) == \
+               fingerprint({3: 4, 1: 2}, unordered=True)
+        assert fingerprint({1, 2}, unordered=True) != \
+               fingerprint(frozenset([1, 2]), unordered=True)
+        assert fingerprint([1], unordered=True) != \
+               fingerprint([True], unordered=True)
+        assert fingerprint({1: 2, 3: 4}) != fingerprint({3: 4, 1: 2})
+
+
+class TestDiffThreshold(object):
+    want = "\n".join("            {0}".format(idx) for idx in range(3000))
+    src = '''
+        def numbers():
+            """
+            >>> for idx in range(3000): print(idx if idx != 1500 else "X")
+%s
+            """
+    ''' % want
+
+    def test_bounded(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=repr",
+                                   "--doctest-diff-threshold=20")
+        result.assert_outcomes(passed=0, skipped=0, failed=1)
+        result.stdout.fnmatch_lines([
+          "*@@ -3,5 +3,5 @@", # The 1st line is the elision marker
+          "*1499",
+          "*-1500",
+          "*+X",
+          "*1501",
+        ])
+
+    def test_below_threshold(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-modules", "--doctest-repr=repr",
+                                   "--doctest-diff-threshold=5000")
+        result.assert_outcomes(passed=0, skipped=0, failed=1)
+        result.stdout.fnmatch_lines("*@@ -1499,5 +1499,5 @@")
+
+    def test_bounded_diff_example(self):
+        import doctest
+        want = "".join("{0}\n".format(idx) for idx in range(20))
+        example = doctest.Example("numbers()", want)
+        bounded, got = pytest_doctest_custom.bounded_diff_example(
+                         example, want.replace("10\n", "X\n"), threshold=5)
+        assert bounded.want.splitlines() == [
+          "<doctest-diff: 7 equal lines elided>", "7", "8", "9", "10", "11",
+          "12", "13", "<doctest-diff: 6 equal lines elided>",
+        ]
+        assert got == bounded.want.replace("10\n", "X\n")
+        assert example.want == want
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason="Top-level await requires Python 3.8+")
+class TestDoctestAsync(object):
+    src = '''
+        import asyncio
+        LOOPS = []
+        async def a_shout(text):
+            """
+            >>> await a_shout("Hey")
+            HEY!
+            >>> text = await a_shout("Hey"); text.lower()
+            hey!
+            """
+            await asyncio.sleep(0)
+            return text.upper() + "!"
+        async def b_loops():
+            """
+            >>> await b_loops()
+            1
+            """
+            LOOPS.append(asyncio.get_running_loop())
+            return len(set(LOOPS))
+        async def c_loops():
+            """
+            >>> await c_loops()
+            1
+            >>> await c_loops()
+            1
+            """
+            return await b_loops()
+    '''
+    args = "--doctest-modules", "--doctest-repr=str"
+
+    def test_module_scope(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-async=module", *self.args)
+        result.assert_outcomes(passed=3, skipped=0, failed=0)
+        result.stdout.fnmatch_lines([
+          "*doctest async loops*",
+          "1 event loops, *s setup, *s teardown",
+        ])
+
+    def test_docstring_scope(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest("--doctest-async=docstring", *self.args)
+        result.assert_outcomes(passed=2, skipped=0, failed=1)
+        result.stdout.fnmatch_lines([
+          "*test_docstring_scope.c_loops*",
+          "Expected:",
+          "    1",
+          "Got:",
+          "    2",
+        ])
+
+    def test_disabled(self, testdir):
+        testdir.makepyfile(self.src)
+        result = testdir.runpytest(*self.args)
+        result.assert_outcomes(passed=0, skipped=0, failed=3)
+
+
 def test_help_message(testdir):
     testdir.runpytest("--help").stdout.fnmatch_lines([
       pytest_doctest_custom.HELP["plugin"].join("*:"),